@@ -0,0 +1,125 @@
+__doc__ = (
+"""
+  Benchmark the edge selection of construct_gcn.py on a random correlation matrix.
+  The legacy per-cell loop is timed on the first <legacy_rows> rows only,
+  and its time for the whole matrix is extrapolated from the number of scanned cells.
+
+usage:
+{f} [-n <genes>] [-r <legacy_rows>] [<max_neg> <min_pos>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  -n <genes>               specify the number of genes [default: 20000].
+  -r <legacy_rows>         specify the number of rows for the legacy loop [default: 200].
+  <max_neg>                specify the maximum negative value of correlation [default: 0.8].
+  <min_pos>                specify the minimum positive value of correlation [default: 0.8].
+""").format(f=__file__)
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import networkx as nx
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import construct_gcn
+import corr_engine
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '-n': And(Use(int), lambda n: 0 < n),
+  '-r': And(Use(int), lambda n: 0 < n),
+  '<max_neg>': Or(None, Use(float)),
+  '<min_pos>': Or(None, Use(float)),
+})
+
+dict_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dict_final.csv')
+
+def random_corr_matrix(genes, seed=0):
+  """A correlation-like matrix: symmetric, unit diagonal, off-diagonal values mostly near 0."""
+  rng = np.random.default_rng(seed)
+  n = len(genes)
+  values = np.empty((n, n))
+  # fill the matrix block by block in place, mirroring the upper triangle.
+  for start in range(0, n, 1000):
+    stop = min(start + 1000, n)
+    values[start:stop, start:] = rng.normal(0.0, 0.25, (stop - start, n - start))
+    values[start:stop, :start] = values[:start, start:stop].T
+  np.clip(values, -1.0, 1.0, out=values)
+  for start in range(0, n, 1000):
+    stop = min(start + 1000, n)
+    values[start:stop, start:stop] = np.triu(values[start:stop, start:stop], 1)
+    values[start:stop, start:stop] += values[start:stop, start:stop].T
+  np.fill_diagonal(values, 1.0)
+  return pd.DataFrame(values, index=genes, columns=genes)
+
+def legacy_select(mat, normals, max_neg, min_pos, rows):
+  """The per-cell loop of construct_gcn.py before vectorization (rows [0, rows) only)."""
+  g = nx.Graph()
+  allgenes = mat.columns
+  cols = len(allgenes)
+  for i in range(rows):
+    gene_i = mat.index.values[i]
+    if gene_i not in normals:
+      continue
+    for j in range(i+1, cols):
+      corr_value = mat.iat[i,j]
+      if max_neg >= corr_value or min_pos <= corr_value:
+        gene_j = allgenes[j]
+        if gene_j in normals:
+          g.add_edge(gene_i, gene_j, weight=round(corr_value, 5))
+  return g
+
+def vectorized_select(mat, normals, max_neg, min_pos):
+  g = nx.Graph()
+  genes = mat.index.values
+  is_normal = np.isin(genes, list(normals))
+  edge_i, edge_j, weight = corr_engine.select_edges(mat.to_numpy(), 0, max_neg, min_pos,
+                                                    row_mask=is_normal, col_mask=is_normal)
+  g.add_weighted_edges_from(zip(genes[edge_i], genes[edge_j], np.round(weight, 5).tolist()))
+  return g
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  n = args['-n']
+  legacy_rows = min(args['-r'], n)
+  max_neg = -1.0 * (args['<max_neg>'] if args['<max_neg>'] is not None else 0.8)
+  min_pos = args['<min_pos>'] if args['<min_pos>'] is not None else 0.8
+
+  gene_dict = pd.read_csv(dict_file, index_col=0)
+  genes = gene_dict.index.values[:n]
+  g, normals = construct_gcn.add_vertices(nx.Graph(), genes, gene_dict)
+  mat = random_corr_matrix(genes)
+  print("{0} x {0} matrix, {1} normal genes".format(n, len(normals)))
+
+  t = time.perf_counter()
+  g_vec = vectorized_select(mat, normals, max_neg, min_pos)
+  t_vec = time.perf_counter() - t
+  print("vectorized: {0:.2f} s, {1} edges".format(t_vec, g_vec.number_of_edges()))
+
+  t = time.perf_counter()
+  g_legacy = legacy_select(mat, normals, max_neg, min_pos, legacy_rows)
+  t_legacy = time.perf_counter() - t
+  scanned = legacy_rows * (n - 1) - legacy_rows * (legacy_rows - 1) // 2
+  t_legacy_all = t_legacy * (n * (n - 1) // 2) / scanned
+  print("legacy: {0:.2f} s for {1} rows, {2:.1f} s extrapolated".format(t_legacy, legacy_rows, t_legacy_all))
+
+  # check that both give the same edges on the rows run by the legacy loop.
+  head = set(genes[:legacy_rows])
+  same = all(g_vec.has_edge(u, v) and g_vec.edges[u, v]['weight'] == d['weight'] for u, v, d in g_legacy.edges(data=True))
+  same = same and g_legacy.number_of_edges() == sum(1 for u, v in g_vec.edges if u in head or v in head)
+  print("same edges: {0}".format(same))
+  print("speedup: {0:.0f}x".format(t_legacy_all / t_vec))
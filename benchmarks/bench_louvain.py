@@ -0,0 +1,90 @@
+__doc__ = (
+"""
+  Benchmark the community detection backends of louvain_clustering.py on a random graph
+  with planted communities (weights drawn from correlation-like values).
+  Backends that are not installed are skipped.
+
+usage:
+{f} [-n <nodes>] [-c <communities>] [-d <degree>] [-B <backends>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  -n <nodes>               specify the number of nodes [default: 20000].
+  -c <communities>         specify the number of planted communities [default: 50].
+  -d <degree>              specify the average degree [default: 20].
+  -B <backends>            specify the backends to compare (comma-separated) [default: louvain,igraph,leiden].
+""").format(f=__file__)
+
+import os
+import sys
+import time
+import numpy as np
+import networkx as nx
+import scipy.sparse as sp
+import community as community_louvain
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import louvain_clustering
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '-n': And(Use(int), lambda n: 0 < n),
+  '-c': And(Use(int), lambda n: 0 < n),
+  '-d': And(Use(float), lambda n: 0 < n),
+  '-B': And(Use(lambda s: s.split(',')), lambda l: all(b in louvain_clustering.backends for b in l)),
+})
+
+def planted_graph(n, n_communities, degree, seed=0):
+  """A graph whose edges fall inside the planted communities with probability 0.8.
+
+  Returns the graph with |weight| in [0.6, 1.0] on its edges.
+  """
+  rng = np.random.default_rng(seed)
+  labels = rng.integers(0, n_communities, n)
+  m = int(n * degree / 2)
+  u = rng.integers(0, n, m)
+  v = rng.integers(0, n, m)
+  # rewire 80% of the edges into the community of u.
+  inside = rng.random(m) < 0.8
+  members = [np.flatnonzero(labels == c) for c in range(n_communities)]
+  for c in range(n_communities):
+    pick = inside & (labels[u] == c)
+    v[pick] = rng.choice(members[c], pick.sum())
+  keep = u != v
+  adj = sp.coo_matrix((rng.uniform(0.6, 1.0, keep.sum()), (u[keep], v[keep])), shape=(n, n)).tocsr()
+  adj = sp.triu(adj + adj.T, 1).tocsr()
+  g = nx.Graph()
+  g.add_nodes_from(range(n))
+  upper = adj.tocoo()
+  g.add_weighted_edges_from(zip(upper.row.tolist(), upper.col.tolist(), upper.data.tolist()))
+  return g
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  g = planted_graph(args['-n'], args['-c'], args['-d'])
+  print("n = {0}, m = {1}".format(g.number_of_nodes(), g.number_of_edges()))
+  nodes = list(g.nodes)
+  adj = nx.to_scipy_sparse_array(g, nodelist=nodes, weight='weight', format='csr')
+
+  for backend in args['-B']:
+    t = time.perf_counter()
+    try:
+      partition = louvain_clustering.find_partition(g, backend, seed=0, adj=adj)
+    except ImportError as error:
+      print("{0}: skipped ({1})".format(backend, error))
+      continue
+    elapsed = time.perf_counter() - t
+    print("{0}: {1:.2f} s, {2} communities, modularity = {3:.4f}".format(
+      backend, elapsed, len(set(partition.values())), community_louvain.modularity(partition, g)))
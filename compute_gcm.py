@@ -1,12 +1,13 @@
 __doc__ = (
 """ 
   Compute the correlation matrix of genes from .mtx|.tsv|.csv file.
-  Default output: "data_dir"/[corr_|wom_corr_]"data_prefix".csv
+  Default output: "data_dir"/[corr_|wom_corr_]"data_prefix".csv (.gcm with '-b', .npz with '-e')
   ('data_dir' is the directory of <data_file>, 'data_prefix' is the prefix of <data_file>)
   ('corr_' is default, 'wom_corr' is used by '-n' option.)
   
 usage:
-{f} <data_file> [-c <threshold_cell>] [-g <threshold_gene>] [-n] [-m] [-o <output_file>]
+{f} <data_file> [-c <threshold_cell>] [-g <threshold_gene>] [-n] [-m [-r <shard_rows>] [-S <shard_size>] [-w <writers>]] [-b [-d <dtype>]] [-e (<max_neg> <min_pos>)] [-t <tile_rows>] [-M <mem_budget>] [-C <cache_dir> [-Z <cache_size>]] [-o <output_file>]
+    [-k <knn>] [-T <t>] [-D <decay>] [-P <n_pca>] [-a] [-j <jobs>] [-v <dict_file>] [-f]
 {f} -h | --help
 
 options:
@@ -15,8 +16,28 @@ options:
   -c <threshold_cell>     specify the threshold of cells [default: 0].
   -g <threshold_gene>     specify the threshold of genes [default: 0].
   -n                      run without MAGIC.
-  -m                      output multiple files. 
+  -m                      output multiple files (shards) and their manifest "data_dir"/[corr_|wom_corr_]"data_prefix"_manifest.json.
+  -r <shard_rows>         specify the number of rows of a shard [default: 100].
+  -S <shard_size>         specify the approximate size of a shard in MB instead of -r [default: 0].
+  -w <writers>            specify the number of processes writing shards [default: 1].
+  -b                      output a binary correlation store (.gcm directory) instead of csv.
+  -d <dtype>              specify the dtype of the binary store (float32|float64) [default: float64].
+  [-e (<max_neg> <min_pos>)]  output only the edges of the network (see construct_gcn.py) as an .npz edge list.
+  -t <tile_rows>          specify the number of rows of a correlation tile (0: derived from -M) [default: 0].
+  -M <mem_budget>         specify the memory budget for a correlation tile in MB [default: 1024].
+  -C <cache_dir>          reuse (or store) the preprocessed, imputed and correlation matrices in a result cache (see result_cache.py).
+  -Z <cache_size>         specify the maximum size of the cache in MB; the least recently used entries are removed [default: 10240].
   -o <output_file>        specify the output file.
+  -k <knn>                specify the number of nearest neighbors of MAGIC [default: 10].
+  -T <t>                  specify the diffusion time of MAGIC (a positive integer or auto) [default: 10].
+  -D <decay>              specify the decay rate of the kernel of MAGIC [default: 15].
+  -P <n_pca>              specify the number of principal components of MAGIC (0: no PCA) [default: 100].
+  -a                      run MAGIC with its approximate solver, which imputes in the PCA space instead of the gene space
+                          (faster, but the correlations can differ much from the exact solver; the kNN search itself is exact).
+  -j <jobs>               specify the number of threads of MAGIC (-1: all cores) [default: 1].
+  -v <dict_file>          impute and correlate only the genes that become vertices with the dictionary file (see construct_gcn.py).
+  -f                      keep the imputed and the standardized matrices and compute the correlation in float32
+                          (MAGIC itself still imputes in float64, so its peak memory is unchanged).
 """).format(f=__file__)
 
 import magic
@@ -24,8 +45,12 @@ import scprep
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import matplotlib
 import matplotlib.pyplot as plt
+import corr_engine
+import corr_store
+import result_cache
 import os
 import sys
 from docopt import docopt
@@ -39,10 +64,33 @@ schema = Schema({
   '-g': And(Use(int), lambda n: 0 <= n),
   '-n': bool,
   '-m': bool,
+  '-r': And(Use(int), lambda n: 0 < n),
+  '-S': And(Use(float), lambda n: 0 <= n),
+  '-w': And(Use(int), lambda n: 0 < n),
+  '-b': bool,
+  '-d': And(Use(str), lambda s: s in ['float32', 'float64'], error="<dtype> should be float32 or float64"),
+  '-e': bool,
+  '<max_neg>': Or(None, Use(float)),
+  '<min_pos>': Or(None, Use(float)),
+  '-t': And(Use(int), lambda n: 0 <= n),
+  '-M': And(Use(float), lambda n: 0 < n),
+  Optional('-C'): Use(str),
+  '-Z': And(Use(float), lambda n: 0 <= n),
+  '-k': And(Use(int), lambda n: 0 < n),
+  '-T': Or(And(str, lambda s: s == 'auto'), And(Use(int), lambda n: 0 < n), error="<t> should be a positive integer or auto"),
+  '-D': And(Use(float), lambda n: 0 < n),
+  '-P': And(Use(int), lambda n: 0 <= n),
+  '-a': bool,
+  '-j': And(Use(int), lambda n: n != 0),
+  Optional('-v'): Use(str),
+  '-f': bool,
   Optional('-o'): Use(str),
 })
 
-def load_emt(data_file, result_file, is_magic):
+# the default MAGIC parameters (t='auto' is also possible).
+magic_params = {'t': 10, 'decay': 15, 'knn': 10, 'n_pca': 100, 'solver': 'exact'}
+
+def result_filename(data_file, result_file, is_magic, ext='.csv'):
   data_dir, data_filename = os.path.split(os.path.abspath(data_file))
   data_file_without_ext, data_type = os.path.splitext(data_filename)
   
@@ -50,11 +98,27 @@ def load_emt(data_file, result_file, is_magic):
     pre = '/corr_'
     if not is_magic:
       pre = '/wom_corr_'
-    result_file = data_dir + pre + data_file_without_ext + '.csv'
+    result_file = data_dir + pre + data_file_without_ext + ext
   else:
     result_file = os.path.abspath(result_file) 
   print(result_file)
+  return result_file
+
+def input_files(data_file):
+  """The files read by load_emt for data_file."""
+  data_dir, data_filename = os.path.split(os.path.abspath(data_file))
+  data_file_without_ext, data_type = os.path.splitext(data_filename)
+  if data_type == '.mtx':
+    return [data_file, data_dir + '/cells_' + data_file_without_ext + '.tsv', data_dir + '/genes_' + data_file_without_ext + '.tsv']
+  return [data_file]
 
+def load_emt(data_file, result_file, is_magic, ext='.csv'):
+  result_file = result_filename(data_file, result_file, is_magic, ext)
+  return (load_data(data_file), result_file)
+
+def load_data(data_file):
+  data_dir, data_filename = os.path.split(os.path.abspath(data_file))
+  data_file_without_ext, data_type = os.path.splitext(data_filename)
   sparse_flag = False
   if data_type == '.mtx':
     cell_filename = data_dir + '/cells_' + data_file_without_ext + '.tsv'
@@ -64,7 +128,7 @@ def load_emt(data_file, result_file, is_magic):
     emt_data = scprep.io.load_csv(data_file, cell_axis='column', delimiter='\t', sparse=sparse_flag)
   else: # csv
     emt_data = scprep.io.load_csv(data_file, cell_axis='column', delimiter=',', sparse=sparse_flag)
-  return (emt_data, result_file)  
+  return emt_data
  
 
 def preprocessed_data(emt_data, thres_cell, thres_gene):
@@ -84,34 +148,236 @@ def preprocessed_data(emt_data, thres_cell, thres_gene):
   return emt_data
 
 
-def compute_gene_corr(data_file, corr_file, thres_cell, thres_gene, is_magic=True, is_multi=False):
-  (emt_data, corr_file) = load_emt(data_file, corr_file, is_magic)
-  emt_data = preprocessed_data(emt_data, thres_cell, thres_gene)
+def sparse_preprocessed_data(emt_data, thres_cell, thres_gene):
+  """Same as preprocessed_data, but on a scipy sparse matrix without densification.
+
+  Returns the preprocessed cell x gene matrix (CSC) and the remaining genes.
+  """
+  print('preprocess start (sparse)')
   allgenes = emt_data.columns
-  #print(allgenes)
-  
-  magic_op = magic.MAGIC()
+  x = sp.csr_matrix(scprep.utils.to_array_or_spmatrix(emt_data), dtype=np.float64)
+  del emt_data
+  print(x.shape)
+  x = x[np.asarray(x.sum(axis=1)).ravel() > 0]
+  keep_genes = np.asarray((x > 0).sum(axis=0)).ravel() > 0
+  x = x[:, keep_genes]
+  allgenes = allgenes[keep_genes]
+  print(x.shape)
+  if thres_cell > 0:
+    x = x[np.asarray(x.sum(axis=1)).ravel() > thres_cell]
+  print(x.shape)
+  if thres_gene > 0:
+    keep_genes = np.asarray((x > 0).sum(axis=0)).ravel() >= thres_gene
+    x = x[:, keep_genes]
+    allgenes = allgenes[keep_genes]
+  print('preprocess done')
+  print(x.shape)
+  # library size normalization (rescaled to 10000 as scprep does).
+  libsize = np.asarray(x.sum(axis=1)).ravel()
+  libsize[libsize == 0] = 1
+  x = sp.diags(10000 / libsize) @ x
+  return (x.tocsc(), allgenes)
+
+
+def correlation_blocks(emt_data, thres_cell, thres_gene, is_magic=True, params=None, n_jobs=1, gene_dict=None, dtype='float64'):
+  """Preprocess the expression data (and run MAGIC) for computing the correlation matrix.
+
+  params are the MAGIC parameters (magic_params by default), run by n_jobs threads.
+  If gene_dict is given, only the genes that become vertices (see vertex_genes) are imputed and correlated.
+  dtype is the dtype the imputed matrix is kept in (MAGIC imputes in float64) and of the standardized matrix.
+  Returns (allgenes, iter_blocks), where iter_blocks(rows) yields the row blocks
+  (start, stop, block) of the correlation matrix (see corr_engine.iter_corr_blocks).
+  """
+  if not is_magic and scprep.utils.is_sparse_dataframe(emt_data):
+    # sparse input (.mtx) without MAGIC: the data is never densified.
+    (x, allgenes) = select_genes(*sparse_preprocessed_data(emt_data, thres_cell, thres_gene), gene_dict)
+    iter_blocks = lambda rows: corr_engine.iter_sparse_corr_blocks(x, rows)
+  else:
+    emt_data = preprocessed_data(emt_data, thres_cell, thres_gene)
+    allgenes = emt_data.columns
+    #print(allgenes)
+    if gene_dict is not None:
+      allgenes = vertex_genes(allgenes, gene_dict)
+    
+    if is_magic:
+      emt_data = run_magic(emt_data, allgenes, params, n_jobs, dtype)
+    else:
+      emt_data = emt_data[allgenes]
+    # standardize the genes once, then compute the correlation matrix tile by tile.
+    z = corr_engine.standardize(emt_data, dtype)
+    del emt_data
+    iter_blocks = lambda rows: corr_engine.iter_corr_blocks(z, rows)
+  return (allgenes, iter_blocks)
+
+
+def run_magic(emt_data, genes, params=None, n_jobs=1, dtype='float64'):
+  """Impute the genes of emt_data by MAGIC with params (magic_params by default).
+
+  MAGIC returns float64 whatever the input is; the result is cast to dtype afterwards.
+  """
+  magic_op = magic.MAGIC(n_jobs=n_jobs)
+  magic_op.set_params(**(magic_params if params is None else params))
+  print('MAGIC: {0} genes of {1}'.format(len(genes), emt_data.shape[1]))
+  return magic_op.fit_transform(emt_data, genes=genes).astype(dtype, copy=False)
+
+
+def vertex_genes(allgenes, gene_dict):
+  """The genes of allgenes that become vertices of the network (see construct_gcn.vertex_table)."""
+  import construct_gcn
+  return pd.Index(construct_gcn.vertex_table(allgenes, gene_dict).index)
+
+def dictionary_digest(gene_dict):
+  """The digest of the vertex genes of gene_dict, used in the cache keys."""
+  import construct_gcn
+  names = np.sort(gene_dict.index[gene_dict['type'].isin(construct_gcn.vertex_types)].to_numpy(dtype=str))
+  return result_cache.entry_key({'vertices': names.tolist()})
+
+def select_genes(x, allgenes, gene_dict=None):
+  """Select the columns of the cells x genes matrix x for the vertex genes of gene_dict (all if None)."""
+  if gene_dict is None:
+    return (x, allgenes)
+  keep = allgenes.isin(vertex_genes(allgenes, gene_dict))
+  return (x[:, keep], allgenes[keep])
+
+
+def save_matrix(cache_dir, key, stage, parts, x, allgenes):
+  """Store a cells x genes matrix x (ndarray or scipy sparse matrix) in the cache."""
+  if sp.issparse(x):
+    x = sp.csc_matrix(x)
+    return result_cache.save_arrays(cache_dir, key, stage, parts, genes=np.asarray(allgenes, dtype=str),
+                                    data=x.data, indices=x.indices, indptr=x.indptr, shape=np.array(x.shape))
+  return result_cache.save_arrays(cache_dir, key, stage, parts, genes=np.asarray(allgenes, dtype=str), matrix=np.asarray(x))
+
+def load_matrix(path):
+  """Load a matrix stored by save_matrix. Returns (x, allgenes)."""
+  allgenes = pd.Index(result_cache.load_array(path, 'genes'))
+  if os.path.exists(os.path.join(path, 'indptr.npy')):
+    load = lambda name: np.array(result_cache.load_array(path, name))
+    return (sp.csc_matrix((load('data'), load('indices'), load('indptr')), shape=tuple(load('shape'))), allgenes)
+  return (np.array(result_cache.load_array(path, 'matrix')), allgenes)
+
+def cached_correlation_blocks(data_file, thres_cell, thres_gene, is_magic, cache_dir, cache_size=10240, mem_budget=1024,
+                              params=None, n_jobs=1, gene_dict=None, dtype='float64'):
+  """correlation_blocks through the result cache in cache_dir (see result_cache.py).
+
+  The preprocessed and imputed matrices, and the correlation matrix if it fits in cache_size MB,
+  are reused from the cache or stored in it; data_file is loaded only if no stage can be reused.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  is_sparse_input = os.path.splitext(data_file)[1] == '.mtx'
+  pre_parts = {'stage': 'preprocessed', 'inputs': [corr_engine.file_sha256(f) for f in input_files(data_file)],
+               'thres_cell': thres_cell, 'thres_gene': thres_gene, 'sparse': is_sparse_input and not is_magic,
+               'versions': result_cache.library_versions()}
+  pre_key = result_cache.entry_key(pre_parts)
+  if params is None:
+    params = magic_params
+  vertices = None if gene_dict is None else dictionary_digest(gene_dict)
+  (parts, key) = (pre_parts, pre_key)
   if is_magic:
-    magic_op.set_params(t=10) #'auto')
-    magic_op.set_params(decay=15)
-    magic_op.set_params(knn=10)
-    emt_magic = magic_op.fit_transform(emt_data, genes=allgenes)
-    corrdata = emt_magic.corr()
+    parts = {'stage': 'imputed', 'input': pre_key, 'magic': params, 'vertices': vertices, 'dtype': dtype}
+    key = result_cache.entry_key(parts)
+  corr_parts = {'stage': 'correlation', 'input': key, 'vertices': vertices, 'dtype': dtype}
+  corr_key = result_cache.entry_key(corr_parts)
+
+  path = result_cache.lookup(cache_dir, corr_key)
+  if path is None:
+    x = None
+    if is_magic and result_cache.lookup(cache_dir, key) is not None:
+      (x, allgenes) = load_matrix(result_cache.entry_path(cache_dir, key))
+    else:
+      pre_path = result_cache.lookup(cache_dir, pre_key)
+      if pre_path is not None:
+        (x, allgenes) = load_matrix(pre_path)
+      else:
+        emt_data = load_data(data_file)
+        if not is_magic and scprep.utils.is_sparse_dataframe(emt_data):
+          (x, allgenes) = sparse_preprocessed_data(emt_data, thres_cell, thres_gene)
+        else:
+          emt_data = preprocessed_data(emt_data, thres_cell, thres_gene)
+          allgenes = emt_data.columns
+          x = scprep.utils.to_array_or_spmatrix(emt_data)
+        del emt_data
+        save_matrix(cache_dir, pre_key, 'preprocessed', pre_parts, x, allgenes)
+      if is_magic:
+        emt_data = pd.DataFrame.sparse.from_spmatrix(x, columns=allgenes) if sp.issparse(x) else pd.DataFrame(x, columns=allgenes)
+        if gene_dict is not None:
+          allgenes = vertex_genes(allgenes, gene_dict)
+        x = np.asarray(run_magic(emt_data, allgenes, params, n_jobs, dtype))
+        del emt_data
+        save_matrix(cache_dir, key, 'imputed', parts, x, allgenes)
+      else:
+        (x, allgenes) = select_genes(x, allgenes, gene_dict)
+    if sp.issparse(x):
+      iter_blocks = lambda rows: corr_engine.iter_sparse_corr_blocks(x, rows)
+    else:
+      z = corr_engine.standardize(x, dtype)
+      del x
+      iter_blocks = lambda rows: corr_engine.iter_corr_blocks(z, rows)
+    n = len(allgenes)
+    if n * n * np.dtype(dtype).itemsize > cache_size * 2**20:
+      # the correlation matrix alone exceeds the cache.
+      result_cache.evict(cache_dir, cache_size)
+      return (allgenes, iter_blocks)
+    tmp_path = result_cache.new_entry(cache_dir, corr_key)
+    chunk_rows = corr_engine.tile_rows_for_budget(n, mem_budget)
+    corr_store.write_store(tmp_path, iter_blocks(chunk_rows), allgenes, dtype=dtype, chunk_rows=chunk_rows)
+    path = result_cache.commit_entry(cache_dir, corr_key, tmp_path, 'correlation', corr_parts)
+  # the entry in use is kept even if it alone exceeds the cache.
+  result_cache.evict(cache_dir, cache_size, keep=[corr_key])
+  allgenes = pd.Index(corr_store.open_store(path)[0])
+  return (allgenes, lambda rows: corr_store.iter_row_chunks(path, rows))
+
+
+def compute_gene_corr(data_file, corr_file, thres_cell, thres_gene, is_magic=True, is_multi=False, tile_rows=0, mem_budget=1024, edge_thres=None, is_binary=False, dtype='float64', shard_rows=100, shard_size=0, writers=1, cache_dir=None, cache_size=10240,
+                      params=None, n_jobs=1, gene_dict=None, work_dtype='float64'):
+  """Compute the correlation matrix of genes.
+
+  If edge_thres = (max_neg, min_pos) is given, only the upper-triangle pairs whose
+  correlation is at most max_neg or at least min_pos are output as an .npz edge list.
+  If is_binary is True, the matrix is output as a correlation store (see corr_store.py).
+  If is_multi is True, the matrix is output as csv shards of shard_rows rows
+  (or about shard_size MB if shard_size > 0), written by writers processes.
+  If cache_dir is given, the intermediate results are reused from the cache (see cached_correlation_blocks).
+  params, n_jobs, gene_dict and work_dtype are given to correlation_blocks.
+  """
+  ext = '.csv'
+  if edge_thres is not None:
+    ext = '.npz'
+  elif is_binary:
+    ext = '.gcm'
+  if cache_dir is not None:
+    corr_file = result_filename(data_file, corr_file, is_magic, ext)
+    (allgenes, iter_blocks) = cached_correlation_blocks(data_file, thres_cell, thres_gene, is_magic, cache_dir, cache_size, mem_budget,
+                                                        params, n_jobs, gene_dict, work_dtype)
   else:
-    corrdata = emt_data.corr()
+    (emt_data, corr_file) = load_emt(data_file, corr_file, is_magic, ext)
+    (allgenes, iter_blocks) = correlation_blocks(emt_data, thres_cell, thres_gene, is_magic, params, n_jobs, gene_dict, work_dtype)
+  n = len(allgenes)
+  if tile_rows == 0:
+    tile_rows = corr_engine.tile_rows_for_budget(n, mem_budget)
+  ## edge list mode
+  if edge_thres is not None:
+    (max_neg, min_pos) = edge_thres
+    edge_i, edge_j, weight = corr_engine.extract_edges(iter_blocks(tile_rows), max_neg, min_pos)
+    print('{0} edges'.format(len(weight)))
+    corr_engine.save_edges(corr_file, allgenes, edge_i, edge_j, weight, max_neg, min_pos)
+  ## binary store mode
+  elif is_binary:
+    print('{0} rows per tile'.format(tile_rows))
+    corr_store.write_store(corr_file, iter_blocks(tile_rows), allgenes, dtype=dtype,
+                           chunk_rows=corr_engine.tile_rows_for_budget(n, mem_budget, np.dtype(dtype).itemsize))
   ## single file mode
-  if not is_multi:
-    corrdata.to_csv(corr_file)
+  elif not is_multi:
+    print('{0} rows per tile'.format(tile_rows))
+    corr_engine.write_corr_csv(iter_blocks(tile_rows), allgenes, corr_file)
   ## multi files mode
   else:
-    corr_dir, corr_filename = os.path.split(corr_file)
-    n = len(corrdata)
-    x = n//100
-    y = n%100
-    for i in range(x):
-      corrdata[i*100:(i+1)*100].to_csv(corr_dir + '/' + str(i) + '_' + corr_filename)
-    if y > 0:
-      corrdata[x*100:(x*100+y)].to_csv(corr_dir + '/' + str(x) + '_' + corr_filename)
+    # each tile becomes a file.
+    if shard_size > 0:
+      shard_rows = corr_engine.shard_rows_for_size(n, shard_size)
+    print('{0} rows per shard'.format(shard_rows))
+    manifest_file = corr_engine.write_corr_shards(iter_blocks(shard_rows), allgenes, corr_file, writers)
+    print(manifest_file)
   
 
 if __name__ == '__main__':
@@ -128,5 +394,27 @@ if __name__ == '__main__':
   if args['-n']:
     is_magic = False
   
-  compute_gene_corr(args['<data_file>'], args['-o'], args['-c'], args['-g'], is_magic, args['-m'])
+  edge_thres = None
+  if args['-e']:
+    # same convention as construct_gcn.py: <max_neg> is given as a positive value.
+    edge_thres = (-1.0 * args['<max_neg>'], args['<min_pos>'])
+  
+  cache_dir = None
+  if args['-C'] != 'None':
+    cache_dir = os.path.abspath(args['-C'])
+  
+  params = {'t': args['-T'], 'decay': args['-D'], 'knn': args['-k'], 'n_pca': args['-P'] if args['-P'] > 0 else None,
+            'solver': 'approximate' if args['-a'] else 'exact'}
+  
+  gene_dict = None
+  if args['-v'] != 'None':
+    import construct_gcn
+    gene_dict = construct_gcn.load_gene_dict(args['-v'])
+  
+  work_dtype = 'float64'
+  if args['-f']:
+    work_dtype = 'float32'
+  
+  compute_gene_corr(args['<data_file>'], args['-o'], args['-c'], args['-g'], is_magic, args['-m'], args['-t'], args['-M'], edge_thres, args['-b'], args['-d'], args['-r'], args['-S'], args['-w'],
+                    cache_dir=cache_dir, cache_size=args['-Z'], params=params, n_jobs=args['-j'], gene_dict=gene_dict, work_dtype=work_dtype)
   
\ No newline at end of file
@@ -1,31 +1,50 @@
 __doc__ = (
 """ 
   Construct the graph of genes from correlation data.
-  Default output: "data_dir"/"data_prefix".net
+  Default output: "data_dir"/"data_prefix".net (.gcg with '-b')
+  With '-I <floor>', the pairs with |correlation| >= <floor> are stored once in an edge index
+  "data_dir"/"data_prefix".gci (see edge_index.py), and the network of any thresholds as strict as
+  <floor> is read from the index without scanning the correlation data again.
   ('data_dir' is the directory of <data_file>, 'data_prefix' is the prefix of <data_file>)
   
 usage:
-{f} <data_file> <dict_file> <max_neg> <min_pos> [-c] [-m (<from> <to>)] [-o <output_file>]
+{f} <data_file> <dict_file> <max_neg> <min_pos> [-c] [-m (<from> <to>)] [-j <jobs>] [-I <floor> | -K <k> [-S <sign>]] [-b] [-o <output_file>]
 {f} -h | --help
 
 options:
   -h, --help               show this help message and exit.
-  <data_file>              specify the data file containing correlation data (gene x gene matrix).
+  <data_file>              specify the data file containing correlation data (gene x gene matrix),
+                           a manifest (.json) of the files generated by compute_gcm.py with '-m',
+                           a correlation store (.gcm) generated by compute_gcm.py with '-b',
+                           or an .npz edge list generated by compute_gcm.py with '-e'.
   <dict_file>              specify the dictionary file.
   <max_neg>                specify the maximum negative value of correlation.
   <min_pos>                specify the minimum positive value of correlation.
   -c                       set circular coordinate flag
   [-m (<from> <to>)]       input files (<from><data_file> .. <to><data_file>) generated by compute_gcm.py with multi-mode. 
+  -j <jobs>                specify the number of processes reading the input files of multi-mode (or a manifest) [default: 1].
+  -I <floor>               use (and build if needed) the edge index of |correlation| >= <floor> (e.g., 0.5).
+  -K <k>                   keep the <k> strongest partners of each gene (use 0 0 as thresholds for a pure top-k network).
+  -S <sign>                specify the partners kept by -K: pos, neg or both (<k> of each) [default: both].
+  -b                       output a binary graph store (.gcg directory) instead of Pajek (.net).
   -o <output_file>         specify the output file.
 """).format(f=__file__)
 
-import math
+import hashlib
+import io
+import json
+import zipfile
 import numpy as np
 import pandas as pd
 import networkx as nx
 from mypajek import *
+import corr_engine
+import corr_store
+import graph_store
+import edge_index
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt
 from schema import Schema, SchemaError, And, Or, Use, Optional
 
@@ -39,6 +58,11 @@ schema = Schema({
   '<max_neg>': Use(float),
   '-c': bool,
   '-m': bool,
+  '-b': bool,
+  '-j': And(Use(int), lambda n: 0 < n, error="<jobs> should be a positive integer"),
+  '-K': Or(None, And(Use(int), lambda n: 0 < n), error="<k> should be a positive integer"),
+  '-S': And(Use(str), lambda s: s in ['pos', 'neg', 'both'], error="<sign> should be pos, neg or both"),
+  '-I': Or(None, And(Use(float), lambda n: 0 < n <= 1), error="<floor> should be in (0, 1]"),
   Optional('-o'): Use(str),
   '<from>': Or(None, And(Use(int), lambda n: 0 <= n), error="<from> should be a positive integer"),
   '<to>': Or(None, And(Use(int), lambda n: 0 <= n), error="<to> should be a positive integer"),
@@ -56,89 +80,382 @@ radius = 0.5
 start = 0.5 * np.pi
 clockwise = 1
 
-def add_vertices(g, allgenes, gene_dict):
-  cols = len(allgenes)
-  # we will use only type==Normal genes. 
-  # set for manage them.
-  normals = set()
-  for i in range(cols):
-    gene = allgenes[i]
-    # sometimes gene includes two names whose seperator is a comma.
-    # anyway, we use the first name only.
-    first_gene = (gene.split(','))[0]
-    #print(firstGene)
+# gene types used as vertices, and the chromosome numbers of X and Y.
+vertex_types = ['Normal', 'Xtype', 'Ytype']
+chr_X = 23
+chr_Y = 24
+# the version of the binary cache of a dictionary file (see load_gene_dict).
+dict_cache_version = 1
+
+def save_dict_cache(cache_file, gene_dict, digest):
+  """Write the dictionary as an .npz file (no pickled objects) with the sha256 of its csv file."""
+  arrays = {'version': np.array(dict_cache_version), 'digest': np.array(digest),
+            'index': gene_dict.index.to_numpy(dtype=str), 'index_name': np.array(gene_dict.index.name or ''),
+            'columns': np.asarray(gene_dict.columns, dtype=str)}
+  for k, column in enumerate(gene_dict.columns):
+    values = gene_dict[column]
+    if values.dtype == object:
+      arrays['null{0}'.format(k)] = values.isna().to_numpy()
+      values = values.fillna('').to_numpy(dtype=str)
+    arrays['col{0}'.format(k)] = np.asarray(values)
+  with open(cache_file, 'wb') as f:
+    np.savez(f, **arrays)
+
+def load_dict_cache(cache_file, digest):
+  """Read a dictionary written by save_dict_cache, or None if it is not of this version or of the csv file of digest."""
+  with np.load(cache_file, allow_pickle=False) as data:
+    if int(data['version']) != dict_cache_version or str(data['digest']) != digest:
+      return None
+    index = pd.Index(data['index'], name=str(data['index_name']) or None)
+    gene_dict = pd.DataFrame({column: data['col{0}'.format(k)] for k, column in enumerate(data['columns'].tolist())}, index=index)
+    for k, column in enumerate(gene_dict.columns):
+      if 'null{0}'.format(k) in data.files:
+        gene_dict[column] = gene_dict[column].astype(object).mask(data['null{0}'.format(k)])
+  return gene_dict
+
+def load_gene_dict(dict_file):
+  """Read the dictionary file through its binary cache "<dict_prefix>.dict.npz".
+
+  The cache is used only if it was written from the dictionary file as it is now (by its sha256);
+  otherwise, or if the cache cannot be read, it is (re)built next to the dictionary file.
+  """
+  cache_file = os.path.splitext(dict_file)[0] + '.dict.npz'
+  digest = corr_engine.file_sha256(dict_file)
+  if os.path.exists(cache_file):
     try:
-      gene_data = gene_dict.loc[first_gene]
-    except KeyError:
-      #print(first_gene + ' is not found in the dictionary')
-      continue
-    gene_type = gene_data['type']
-    gene_c1 = gene_data['c1']
-    # 'c2' is unused currently 
-    #gene_c2 = gene_data['c2']
-    gene_start = gene_data['start']
-    # 'end' is unused currently
-    #gene_end = gene_data['end'] 
-    # print('gene data: name: {0}, type: {1}, c1: {2}'.format(first_gene, gene_type, gene_c1))
-    # we will use only type==Normal, Xtype, Ytype genes.
-    if gene_type == 'Xtype':
-      gene_c1 = 23
-    elif gene_type == 'Ytype':
-      gene_c1 = 24
-    if gene_type in ['Normal', 'Xtype', 'Ytype']:
-      normals.add(gene)
-      if not circularmode:
-        gene_X = gene_start * unit_X
-        gene_Y = 1.0 - gene_c1 * unit_Y
-      else:
-        diff = gene_c1 + unit_X * gene_start
-        theta = start - (clockwise * 2.0 * np.pi * diff/ (chr_num + 1))
-        gene_X = center + radius * math.cos(theta)
-        gene_Y = center + radius * math.sin(theta) 
-      g.add_node(gene, x = round(gene_X, 5), y = round(gene_Y, 5))
-  return (g, normals)
-
-def convert_corrmatrices2graph(max_neg, min_pos, corr_file, dict_file, is_multi=False, index_from=0, index_to=0, circularmode = False):
-  print(dict_file)
+      gene_dict = load_dict_cache(cache_file, digest)
+      if gene_dict is not None:
+        return gene_dict
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+      print('warning: ignoring the dictionary cache {0} ({1})'.format(cache_file, error))
   gene_dict = pd.read_csv(dict_file, index_col=0)
-  g = nx.Graph()
-  totalrows = 0
+  try:
+    save_dict_cache(cache_file, gene_dict, digest)
+  except OSError:
+    # the directory of the dictionary may be read-only.
+    pass
+  return gene_dict
+
+def vertex_table(allgenes, gene_dict, circularmode=False):
+  """Compute the coordinates of the vertices for the genes.
+
+  Sometimes a gene includes two names whose seperator is a comma; the first name is used
+  to look up the dictionary. Only the genes of type Normal, Xtype and Ytype are used.
+  Returns a DataFrame indexed by the genes with columns 'x' and 'y'.
+  """
+  allgenes = np.asarray(allgenes)
+  first_genes = pd.Series(allgenes, dtype=str).str.split(',', n=1).str[0]
+  gene_data = gene_dict.reindex(first_genes.values)
+  gene_type = gene_data['type'].values
+  used = np.isin(gene_type, vertex_types)
+  gene_c1 = gene_data['c1'].to_numpy(dtype=np.float64)
+  gene_c1[gene_type == 'Xtype'] = chr_X
+  gene_c1[gene_type == 'Ytype'] = chr_Y
+  # 'c2' and 'end' are unused currently
+  gene_start = gene_data['start'].to_numpy(dtype=np.float64)
+  if not circularmode:
+    gene_X = gene_start * unit_X
+    gene_Y = 1.0 - gene_c1 * unit_Y
+  else:
+    diff = gene_c1 + unit_X * gene_start
+    theta = start - (clockwise * 2.0 * np.pi * diff/ (chr_num + 1))
+    gene_X = center + radius * np.cos(theta)
+    gene_Y = center + radius * np.sin(theta)
+  return pd.DataFrame({'x': np.round(gene_X[used], 5), 'y': np.round(gene_Y[used], 5)}, index=allgenes[used])
+
+def lookup_vertices(allgenes, dict_table):
+  """Same as vertex_table, but looks up the coordinates in dict_table, the vertex table of all the genes
+  of the dictionary (vertex_table(gene_dict.index, gene_dict)), which can be shared by many datasets."""
+  allgenes = np.asarray(allgenes)
+  first_genes = pd.Series(allgenes, dtype=str).str.split(',', n=1).str[0].values
+  index = dict_table.index.get_indexer(first_genes)
+  used = index >= 0
+  table = dict_table.iloc[index[used]]
+  table.index = allgenes[used]
+  return table
+
+def add_vertices(g, allgenes, gene_dict, circularmode=False):
+  # we will use only type==Normal, Xtype, Ytype genes. 
+  # set for manage them.
+  table = vertex_table(allgenes, gene_dict, circularmode)
+  g.add_nodes_from((gene, {'x': x, 'y': y}) for gene, x, y in zip(table.index, table['x'].tolist(), table['y'].tolist()))
+  return (g, set(table.index))
+
+def add_weighted_edges(g, genes_u, genes_v, weight):
+  """Add the edges (genes_u[k], genes_v[k]) with weight[k] rounded to 5 digits."""
+  weight = np.round(np.asarray(weight, dtype=np.float64), 5)
+  g.add_weighted_edges_from(zip(genes_u, genes_v, weight.tolist()))
+
+def edges2arrays(max_neg, min_pos, allgenes, edge_i, edge_j, weight, gene_dict, circularmode=False, dict_table=None):
+  """Threshold an edge list over allgenes and map it to the vertices, without building a graph.
+
+  The vertices are looked up in dict_table if it is given (see lookup_vertices).
+
+  Returns (names, x, y, u, v, weight): the vertices in the order of add_vertices, and the edges
+  (names[u[k]], names[v[k]]) with weight[k] rounded to 5 digits.
+  """
+  if dict_table is not None:
+    table = lookup_vertices(allgenes, dict_table)
+  else:
+    table = vertex_table(allgenes, gene_dict, circularmode)
+  index = table.index.get_indexer(allgenes)
+  is_normal = index >= 0
+  keep = is_normal[edge_i] & is_normal[edge_j] & ((weight <= max_neg) | (weight >= min_pos))
+  weight = np.round(np.asarray(weight[keep], dtype=np.float64), 5)
+  return (table.index.values, table['x'].values, table['y'].values, index[edge_i[keep]], index[edge_j[keep]], weight)
+
+def arrays2graph(names, x, y, u, v, weight, g):
+  """Add the vertices and the edges given by edges2arrays to g."""
+  g.add_nodes_from((gene, {'x': xi, 'y': yi}) for gene, xi, yi in zip(names, np.asarray(x).tolist(), np.asarray(y).tolist()))
+  add_weighted_edges(g, names[u], names[v], weight)
+  return g
+
+def check_edge_thresholds(edge_file, max_neg, min_pos):
+  """Raise ValueError if (max_neg, min_pos) is looser than the thresholds the edge list was cut at."""
+  thresholds = corr_engine.load_edge_thresholds(edge_file)
+  if thresholds is None:
+    print('warning: {0} does not record its thresholds; the edges looser than them are missing'.format(edge_file))
+  elif max_neg > thresholds[0] or min_pos < thresholds[1]:
+    raise ValueError('the thresholds ({0}, {1}) are looser than those of the edge list {2} ({3}, {4})'.format(
+      max_neg, min_pos, edge_file, thresholds[0], thresholds[1]))
+  return thresholds
+
+def convert_edges2graph(max_neg, min_pos, edge_file, gene_dict, g, circularmode=False):
+  """Construct the graph from an edge list generated by compute_gcm.py with '-e'."""
+  print(edge_file)
+  check_edge_thresholds(edge_file, max_neg, min_pos)
+  allgenes, edge_i, edge_j, weight = corr_engine.load_edges(edge_file)
+  print("{0} genes, {1} edges".format(len(allgenes), len(weight)))
+  return arrays2graph(*edges2arrays(max_neg, min_pos, allgenes, edge_i, edge_j, weight, gene_dict, circularmode), g)
+
+def convert_store2graph(max_neg, min_pos, store_path, gene_dict, g, circularmode=False):
+  """Construct the graph from a correlation store generated by compute_gcm.py with '-b'.
+
+  The matrix is memory-mapped and scanned chunk by chunk.
+  """
+  print(store_path)
+  allgenes, matrix, meta = corr_store.open_store(store_path)
+  print("{0} rows, {1} cols ({2})".format(meta['shape'][0], meta['shape'][1], meta['dtype']))
+  g, normals = add_vertices(g, allgenes, gene_dict, circularmode)
+  is_normal = np.isin(allgenes, list(normals))
+  for (start, stop, block) in corr_store.iter_row_chunks(store_path):
+    edge_i, edge_j, weight = corr_engine.select_edges(block, start, max_neg, min_pos,
+                                                      row_mask=is_normal[start:stop], col_mask=is_normal)
+    add_weighted_edges(g, allgenes[start + edge_i], allgenes[edge_j], weight)
+  return(g)
+
+def count_rows(csv_file):
+  """Count the data rows of a csv file (the lines except the header) without parsing it."""
+  lines = 0
+  with open(csv_file, 'rb') as f:
+    for buf in iter(lambda: f.read(1 << 24), b''):
+      lines += buf.count(b'\n')
+      last = buf
+  if lines > 0 and not last.endswith(b'\n'):
+    lines += 1
+  return max(lines - 1, 0)
+
+# shared by the shards processed in a worker process.
+shard_context = {}
+
+def init_shard_worker(is_normal, max_neg, min_pos, k=0, sign='both'):
+  shard_context['is_normal'] = is_normal
+  shard_context['max_neg'] = max_neg
+  shard_context['min_pos'] = min_pos
+  shard_context['k'] = k
+  shard_context['sign'] = sign
+
+def threshold_shard(shard_file, offset, checksum=None):
+  """Parse a shard (rows [offset, offset + rows) of the matrix) and select its edges.
+
+  If checksum is given, the sha256 of the shard is verified before parsing.
+  Returns (rows, i, j, weight), where i and j are the gene indices of the edges.
+  """
+  is_normal = shard_context['is_normal']
+  if checksum is None:
+    mat = pd.read_csv(shard_file, header=0, index_col=0)
+  else:
+    with open(shard_file, 'rb') as f:
+      data = f.read()
+    if hashlib.sha256(data).hexdigest() != checksum:
+      raise ValueError('checksum mismatch: ' + shard_file)
+    mat = pd.read_csv(io.BytesIO(data), header=0, index_col=0)
+  rows = len(mat)
+  if shard_context['k'] > 0:
+    # top-k mode: the k strongest partners in each whole row.
+    edge_i, edge_j, weight = corr_engine.select_topk(mat.to_numpy(dtype=np.float64), offset, shard_context['k'],
+                                                     shard_context['sign'], shard_context['max_neg'], shard_context['min_pos'],
+                                                     row_mask=is_normal[offset:offset + rows], col_mask=is_normal)
+  else:
+    edge_i, edge_j, weight = corr_engine.select_edges(mat.to_numpy(dtype=np.float64), offset,
+                                                      shard_context['max_neg'], shard_context['min_pos'],
+                                                      row_mask=is_normal[offset:offset + rows], col_mask=is_normal)
+  return (rows, (offset + edge_i).astype(np.int32), edge_j.astype(np.int32), weight)
+
+def shard_list(corr_file, is_multi=False, index_from=0, index_to=0):
+  """The csv files of a correlation matrix (a single file, a manifest, or the files of multi-mode).
+
+  Returns (shard_files, offsets, checksums): the first row of each file, and its sha256 (None if unknown).
+  """
   corr_dir, corr_filename = os.path.split(corr_file)
-  if not is_multi:
-    index_from = 0
-    index_to = 0 
-  for h in range(index_from, (index_to+1)):
-    if not is_multi:
-      print(corr_file)
-      mat = pd.read_csv(corr_file, header=0, index_col=0)
-    else:
-      id_corr_file = corr_dir + '/' + str(h) + '_' + corr_filename
-      print(id_corr_file)
-      mat = pd.read_csv(id_corr_file, header=0, index_col=0)
-    
-    allgenes = mat.columns
-    rows = len(mat)
-    cols = len(allgenes)
+  checksums = None
+  if os.path.splitext(corr_file)[1] == '.json':
+    print(corr_file)
+    shards = corr_engine.read_manifest(corr_file)
+    shard_files = [shard['file'] for shard in shards]
+    offsets = [shard['start'] for shard in shards]
+    checksums = [shard['sha256'] for shard in shards]
+  elif not is_multi:
+    shard_files = [corr_file]
+    offsets = [0]
+  else:
+    shard_files = [corr_dir + '/' + str(h) + '_' + corr_filename for h in range(0, (index_to+1))]
+    # each shard is assigned the running total of the rows of the previous shards (from shard 0,
+    # so that the offsets are absolute row positions even if <from> is not 0).
+    offsets = np.cumsum([0] + [count_rows(f) for f in shard_files[:-1]]).tolist()
+    shard_files, offsets = shard_files[index_from:], offsets[index_from:]
+  if checksums is None:
+    checksums = [None] * len(shard_files)
+  return (shard_files, offsets, checksums)
+
+def threshold_shards(shard_files, offsets, checksums, is_normal, max_neg, min_pos, jobs=1, k=0, sign='both'):
+  """Apply threshold_shard to the shards by jobs processes, and return the results in order."""
+  if jobs > 1 and len(shard_files) > 1:
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_shard_worker, initargs=(is_normal, max_neg, min_pos, k, sign)) as executor:
+      return list(executor.map(threshold_shard, shard_files, offsets, checksums))
+  init_shard_worker(is_normal, max_neg, min_pos, k, sign)
+  return map(threshold_shard, shard_files, offsets, checksums)
+
+def convert_corrmatrices2graph(max_neg, min_pos, corr_file, dict_file, is_multi=False, index_from=0, index_to=0, circularmode = False, jobs=1):
+  print(dict_file)
+  gene_dict = load_gene_dict(dict_file)
+  g = nx.Graph()
+  if os.path.splitext(corr_file)[1] == '.npz':
+    return convert_edges2graph(max_neg, min_pos, corr_file, gene_dict, g, circularmode)
+  if corr_store.is_store(corr_file):
+    return convert_store2graph(max_neg, min_pos, corr_file, gene_dict, g, circularmode)
+  shard_files, offsets, checksums = shard_list(corr_file, is_multi, index_from, index_to)
+  allgenes = pd.read_csv(shard_files[0], header=0, index_col=0, nrows=0).columns
+  g, normals = add_vertices(g, allgenes, gene_dict, circularmode)
+  is_normal = allgenes.isin(normals)
+  #print('vertices ok')  
+  cols = len(allgenes)
+  results = threshold_shards(shard_files, offsets, checksums, is_normal, max_neg, min_pos, jobs)
+  allgenes = allgenes.values
+  for shard_file, (rows, edge_i, edge_j, weight) in zip(shard_files, results):
+    print(shard_file)
     print("{0} rows, {1} cols".format(rows, cols))
-    if h == index_from:
-      g, normals = add_vertices(g, allgenes, gene_dict)
-      #print('vertices ok')  
-    for i in range(rows):
-      gene_i = mat.index.values[i] #allgenes[i]
-      #print(gene_i)
-      if gene_i not in normals:
-        continue
-      for j in range(totalrows+i+1, cols): #muda ooshi
-        corr_value = mat.iat[i,j]
-        #if corr_value >= min_pos:
-        #  print("({0}, {1}): {2}".format(i, j, corr_value))
-        if max_neg >= corr_value or min_pos <= corr_value:
-          gene_j = allgenes[j]
-          if gene_j in normals:
-            g.add_edge(gene_i, gene_j, weight=round(corr_value, 5))
-    totalrows += rows
+    add_weighted_edges(g, allgenes[edge_i], allgenes[edge_j], weight)
   return(g)
 
+def scan_edges(max_neg, min_pos, corr_file, is_multi=False, index_from=0, index_to=0, jobs=1):
+  """Select the edges of all the genes (not only the vertices) from any input of convert_corrmatrices2graph.
+
+  Returns (allgenes, i, j, weight), the upper-triangle pairs at most max_neg or at least min_pos.
+  """
+  if os.path.splitext(corr_file)[1] == '.npz':
+    check_edge_thresholds(corr_file, max_neg, min_pos)
+    allgenes, edge_i, edge_j, weight = corr_engine.load_edges(corr_file)
+    keep = (weight <= max_neg) | (weight >= min_pos)
+    return (allgenes, edge_i[keep], edge_j[keep], weight[keep])
+  if corr_store.is_store(corr_file):
+    allgenes, matrix, meta = corr_store.open_store(corr_file)
+    results = []
+    for (start, stop, block) in corr_store.iter_row_chunks(corr_file):
+      edge_i, edge_j, weight = corr_engine.select_edges(block, start, max_neg, min_pos)
+      results.append((stop - start, (start + edge_i).astype(np.int32), edge_j.astype(np.int32), weight))
+  else:
+    shard_files, offsets, checksums = shard_list(corr_file, is_multi, index_from, index_to)
+    allgenes = pd.read_csv(shard_files[0], header=0, index_col=0, nrows=0).columns.values
+    is_all = np.ones(len(allgenes), dtype=bool)
+    results = list(threshold_shards(shard_files, offsets, checksums, is_all, max_neg, min_pos, jobs))
+  edge_i = np.concatenate([np.empty(0, np.int32)] + [i for rows, i, j, w in results])
+  edge_j = np.concatenate([np.empty(0, np.int32)] + [j for rows, i, j, w in results])
+  weight = np.concatenate([np.empty(0)] + [w for rows, i, j, w in results])
+  return (allgenes, edge_i, edge_j, weight)
+
+def convert_topk2graph(k, sign, max_neg, min_pos, corr_file, dict_file, is_multi=False, index_from=0, index_to=0, circularmode=False, jobs=1):
+  """Construct the graph in which each vertex keeps its k strongest partners (see corr_engine.select_topk).
+
+  The matrix (csv, manifest, multi-mode or correlation store) is processed tile by tile, and the graph
+  has at most G*k edges (2*G*k with sign 'both'). For an .npz edge list, the partners are chosen among its edges.
+  """
+  print(dict_file)
+  gene_dict = load_gene_dict(dict_file)
+  print(corr_file)
+  if os.path.splitext(corr_file)[1] == '.npz':
+    check_edge_thresholds(corr_file, max_neg, min_pos)
+    allgenes, edge_i, edge_j, weight = corr_engine.load_edges(corr_file)
+    is_normal = np.isin(allgenes, vertex_table(allgenes, gene_dict, circularmode).index)
+    edge_i, edge_j, weight = corr_engine.topk_from_edges(edge_i, edge_j, weight, k, sign, max_neg, min_pos, is_normal)
+  elif corr_store.is_store(corr_file):
+    allgenes, matrix, meta = corr_store.open_store(corr_file)
+    is_normal = np.isin(allgenes, vertex_table(allgenes, gene_dict, circularmode).index)
+    results = []
+    for (start, stop, block) in corr_store.iter_row_chunks(corr_file):
+      ii, jj, ww = corr_engine.select_topk(block, start, k, sign, max_neg, min_pos,
+                                           row_mask=is_normal[start:stop], col_mask=is_normal)
+      results.append((start + ii, jj, ww))
+    edge_i, edge_j, weight = [np.concatenate([r[m] for r in results]) for m in range(3)]
+  else:
+    shard_files, offsets, checksums = shard_list(corr_file, is_multi, index_from, index_to)
+    allgenes = pd.read_csv(shard_files[0], header=0, index_col=0, nrows=0).columns.values
+    is_normal = np.isin(allgenes, vertex_table(allgenes, gene_dict, circularmode).index)
+    results = list(threshold_shards(shard_files, offsets, checksums, is_normal, max_neg, min_pos, jobs, k, sign))
+    edge_i, edge_j, weight = [np.concatenate([r[m] for r in results]) for m in range(1, 4)]
+  edge_i, edge_j, weight = corr_engine.unique_pairs(len(allgenes), edge_i, edge_j, weight)
+  print("{0} genes, {1} edges (top {2}, {3})".format(len(allgenes), len(weight), k, sign))
+  return arrays2graph(*edges2arrays(max_neg, min_pos, allgenes, edge_i, edge_j, weight, gene_dict, circularmode), nx.Graph())
+
+def source_fingerprint(corr_file, is_multi=False, index_from=0, index_to=0):
+  """A fingerprint of the contents of the correlation data, which changes whenever the data is rewritten.
+
+  A correlation store is identified by the sizes and modification times of its arrays and its metadata,
+  a manifest by its contents (the sha256 of the shards), and the other inputs by the sizes and
+  modification times of all their files.
+  """
+  stat = lambda path: [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+  if corr_store.is_store(corr_file):
+    with open(os.path.join(corr_file, corr_store.meta_filename)) as f:
+      parts = [stat(os.path.join(corr_file, corr_store.matrix_filename)),
+               stat(os.path.join(corr_file, corr_store.genes_filename)), f.read()]
+  elif os.path.splitext(corr_file)[1] == '.json':
+    with open(corr_file) as f:
+      parts = [os.path.abspath(corr_file), f.read()]
+  elif os.path.splitext(corr_file)[1] == '.npz':
+    parts = [stat(corr_file)]
+  else:
+    parts = [stat(f) for f in shard_list(corr_file, is_multi, index_from, index_to)[0]]
+  return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+def convert_index2graph(max_neg, min_pos, corr_file, dict_file, floor, index_path, is_multi=False, index_from=0, index_to=0, circularmode=False, jobs=1):
+  """Construct the graph through the edge index of |correlation| >= floor (see edge_index.py).
+
+  The index is (re)built from corr_file by scan_edges unless it is up to date and covers floor.
+  The floor is lowered to cover (max_neg, min_pos), and raised to the thresholds of an .npz edge list,
+  which has no pairs below them.
+  """
+  if min(-max_neg, min_pos) < floor:
+    floor = min(-max_neg, min_pos)
+    print('the floor is lowered to {0} for the thresholds'.format(floor))
+  if os.path.splitext(corr_file)[1] == '.npz':
+    thresholds = check_edge_thresholds(corr_file, max_neg, min_pos)
+    if thresholds is not None and max(-thresholds[0], thresholds[1]) > floor:
+      floor = max(-thresholds[0], thresholds[1])
+      print('the floor is raised to {0} for the thresholds of the edge list'.format(floor))
+  fingerprint = source_fingerprint(corr_file, is_multi, index_from, index_to)
+  if not edge_index.is_fresh(index_path, fingerprint, floor):
+    print('build', index_path)
+    allgenes, edge_i, edge_j, weight = scan_edges(-floor, floor, corr_file, is_multi, index_from, index_to, jobs)
+    edge_index.write_index(index_path, allgenes, edge_i, edge_j, weight, floor, corr_file, fingerprint)
+  print(index_path)
+  index = edge_index.open_index(index_path)
+  edge_i, edge_j, weight = edge_index.select_edges(index, max_neg, min_pos)
+  print("{0} genes, {1} edges".format(len(index[0]), len(weight)))
+  print(dict_file)
+  gene_dict = load_gene_dict(dict_file)
+  return arrays2graph(*edges2arrays(max_neg, min_pos, index[0], edge_i, edge_j, weight, gene_dict, circularmode), nx.Graph())
+
 if __name__ == '__main__':
   args = docopt(__doc__)
   
@@ -161,17 +478,35 @@ if __name__ == '__main__':
   data_file = args['<data_file>']
   data_dir, data_filename = os.path.split(os.path.abspath(data_file))
   data_file_without_ext, data_type = os.path.splitext(data_filename)
+  if data_type == '.json' and data_file_without_ext.endswith('_manifest'):
+    data_file_without_ext = data_file_without_ext[:-len('_manifest')]
   result_file = args['-o']
   if result_file == 'None' or result_file == '':
-    suf = '.net'
+    ext = '.net'
+    if args['-b']:
+      ext = graph_store.store_ext
+    suf = ext
     if circularmode:
-      suf = '_c.net'
+      suf = '_c' + ext
     result_file = data_dir + '/' + data_file_without_ext + suf
   
   
   min_pos = args['<min_pos>']
   max_neg = -1.0 * args['<max_neg>']
 
-  g = convert_corrmatrices2graph(max_neg, min_pos, data_file, args['<dict_file>'], args['-m'], index_from, index_to, circularmode)
-  nx.write_pajek(g, result_file)
+  try:
+    if args['-K'] is not None:
+      g = convert_topk2graph(args['-K'], args['-S'], max_neg, min_pos, data_file, args['<dict_file>'], args['-m'], index_from, index_to, circularmode, args['-j'])
+    elif args['-I'] is not None:
+      index_path = data_dir + '/' + data_file_without_ext + edge_index.index_ext
+      g = convert_index2graph(max_neg, min_pos, data_file, args['<dict_file>'], args['-I'], index_path, args['-m'], index_from, index_to, circularmode, args['-j'])
+    else:
+      g = convert_corrmatrices2graph(max_neg, min_pos, data_file, args['<dict_file>'], args['-m'], index_from, index_to, circularmode, args['-j'])
+  except ValueError as error:
+    print(error)
+    sys.exit(1)
+  if args['-b']:
+    graph_store.write_graph_store(g, result_file)
+  else:
+    nx.write_pajek(g, result_file)
   print("n = {0}, m = {1}".format(g.number_of_nodes(), g.number_of_edges()))
@@ -0,0 +1,333 @@
+"""Blocked correlation engine for gene expression matrices.
+
+The columns (genes) of a cell x gene matrix are standardized once, and the
+gene x gene Pearson correlation matrix is produced as a sequence of row blocks
+(tiles), each computed by a single BLAS matrix product.
+Only one tile is held in memory at a time, so the peak memory is bounded by the
+tile size instead of the square of the number of genes.
+Sparse matrices are handled without densification by iter_sparse_corr_blocks.
+extract_edges applies the thresholds of a network tile by tile, so that only
+the surviving edges are kept instead of the full matrix.
+"""
+
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# approximate size in bytes of a value in a csv file written by to_csv
+# (e.g. "-0.12345678901234567,").
+csv_value_bytes = 21
+manifest_version = 1
+
+
+def tile_rows_for_budget(n_genes, mem_budget, itemsize=8):
+  """Return the number of rows of a tile fitting in the memory budget.
+
+  Parameters
+  ----------
+  n_genes: the number of genes (the width of a tile).
+  mem_budget: memory budget for a tile in MB.
+  itemsize: the size of an element of a tile in bytes.
+  """
+  rows = int(mem_budget * 2**20) // (n_genes * itemsize)
+  return max(1, min(n_genes, rows))
+
+
+def standardize(data, dtype=np.float64):
+  """Center the columns of data and scale them to unit norm.
+
+  For the returned matrix z, z.T @ z is the correlation matrix of the columns.
+  Constant columns become NaN, as in DataFrame.corr().
+  """
+  z = np.array(data, dtype=dtype)
+  z -= z.mean(axis=0)
+  norms = np.sqrt(np.einsum('ij,ij->j', z, z))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    z /= norms
+  return z
+
+
+def iter_corr_blocks(z, tile_rows):
+  """Yield (start, stop, block) for the correlation matrix of standardized z.
+
+  block is the rows [start, stop) of the correlation matrix (tile_rows x genes).
+  """
+  n_genes = z.shape[1]
+  for start in range(0, n_genes, tile_rows):
+    stop = min(start + tile_rows, n_genes)
+    block = z[:, start:stop].T @ z
+    np.clip(block, -1.0, 1.0, out=block)
+    yield (start, stop, block)
+
+
+def write_corr_csv(blocks, genes, corr_file):
+  """Write the row blocks of a correlation matrix to a single csv file.
+
+  Each block is appended as soon as it is given, so the whole matrix is never held in memory.
+  """
+  with open(corr_file, 'w') as f:
+    for (start, stop, block) in blocks:
+      df = pd.DataFrame(block, index=genes[start:stop], columns=genes)
+      df.to_csv(f, header=(start == 0))
+
+
+def shard_rows_for_size(n_genes, shard_size):
+  """Return the number of rows of a csv shard of about shard_size MB."""
+  rows = int(shard_size * 2**20) // (n_genes * csv_value_bytes)
+  return max(1, min(n_genes, rows))
+
+
+def file_sha256(path):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for buf in iter(lambda: f.read(1 << 24), b''):
+      sha.update(buf)
+  return sha.hexdigest()
+
+
+# shared by the shards written in a writer process.
+writer_context = {}
+
+def init_shard_writer(genes):
+  writer_context['genes'] = genes
+
+
+def write_shard(shard_file, start, block):
+  """Write the rows [start, start + len(block)) of the matrix as a csv shard and return its checksum."""
+  genes = writer_context['genes']
+  pd.DataFrame(block, index=genes[start:start + len(block)], columns=genes).to_csv(shard_file)
+  return file_sha256(shard_file)
+
+
+def write_corr_shards(blocks, genes, corr_file, writers=1):
+  """Write each row block of a correlation matrix as a csv shard "<h>_<corr_filename>".
+
+  With writers > 1, the shards are written concurrently by a pool of processes;
+  at most 2 * writers blocks are waiting to be written at a time.
+  A manifest "<corr_prefix>_manifest.json" lists the shards with their row ranges
+  and sha256 checksums. Returns the path of the manifest.
+  """
+  corr_dir, corr_filename = os.path.split(os.path.abspath(corr_file))
+  genes = np.asarray(genes, dtype=str)
+  shards = []
+  pending = deque()
+  executor = None
+  if writers > 1:
+    executor = ProcessPoolExecutor(max_workers=writers, initializer=init_shard_writer, initargs=(genes,))
+  else:
+    init_shard_writer(genes)
+  try:
+    for h, (start, stop, block) in enumerate(blocks):
+      shard_filename = str(h) + '_' + corr_filename
+      shards.append({'file': shard_filename, 'start': int(start), 'stop': int(stop)})
+      shard_file = os.path.join(corr_dir, shard_filename)
+      if executor is None:
+        shards[-1]['sha256'] = write_shard(shard_file, start, block)
+        continue
+      pending.append((shards[-1], executor.submit(write_shard, shard_file, start, block)))
+      while len(pending) > 2 * writers:
+        shard, future = pending.popleft()
+        shard['sha256'] = future.result()
+    for shard, future in pending:
+      shard['sha256'] = future.result()
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  manifest = {'version': manifest_version, 'genes': len(genes), 'shards': shards}
+  manifest_file = os.path.join(corr_dir, os.path.splitext(corr_filename)[0] + '_manifest.json')
+  with open(manifest_file, 'w') as f:
+    json.dump(manifest, f, indent=1)
+  return manifest_file
+
+
+def read_manifest(manifest_file):
+  """Read a manifest written by write_corr_shards.
+
+  Returns the list of the shards, each of which is a dict with 'file' (absolute path),
+  'start', 'stop' and 'sha256'.
+  """
+  manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+  with open(manifest_file) as f:
+    manifest = json.load(f)
+  shards = manifest['shards']
+  for shard in shards:
+    shard['file'] = os.path.join(manifest_dir, shard['file'])
+  return shards
+
+
+def iter_sparse_corr_blocks(x, tile_rows):
+  """Yield (start, stop, block) for the correlation matrix of the columns of a sparse matrix.
+
+  x is never densified: each block is derived from the sparse Gram product of
+  the genes in the block against all genes and the per-gene sums and sums of squares.
+  """
+  x = sp.csc_matrix(x, dtype=np.float64)
+  n_cells, n_genes = x.shape
+  mean = np.asarray(x.sum(axis=0)).ravel() / n_cells
+  sumsq = np.asarray(x.multiply(x).sum(axis=0)).ravel()
+  norms = np.sqrt(np.maximum(sumsq - n_cells * mean * mean, 0.0))
+  # constant genes (up to rounding) have no correlation, as in DataFrame.corr().
+  constant = norms <= 1e-12 * np.sqrt(sumsq)
+  xt = x.T.tocsr()
+  for start in range(0, n_genes, tile_rows):
+    stop = min(start + tile_rows, n_genes)
+    block = (xt[start:stop] @ x).toarray()
+    block -= n_cells * np.outer(mean[start:stop], mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      block /= np.outer(norms[start:stop], norms)
+    block[:, constant] = np.nan
+    block[constant[start:stop]] = np.nan
+    np.clip(block, -1.0, 1.0, out=block)
+    yield (start, stop, block)
+
+
+def select_edges(block, start, max_neg, min_pos, row_mask=None, col_mask=None, chunk_rows=1024):
+  """Select the edges in a row block of a correlation matrix.
+
+  A cell (i, j) of the block is the pair of genes (start + i, j); it is selected
+  if start + i < j and its correlation is at most max_neg or at least min_pos.
+  row_mask and col_mask (boolean arrays) restrict the genes of the rows and the columns.
+  The block is scanned chunk_rows rows at a time to bound the temporary masks.
+  Returns the arrays (i, j, weight), where i is the row index in the block.
+  """
+  list_i, list_j, list_w = [], [], []
+  cols = np.arange(block.shape[1])
+  for c_start in range(0, block.shape[0], chunk_rows):
+    chunk = block[c_start:c_start + chunk_rows]
+    rows = np.arange(c_start, c_start + len(chunk))
+    mask = (chunk <= max_neg) | (chunk >= min_pos)
+    mask &= cols[None, :] > (start + rows)[:, None]
+    if row_mask is not None:
+      mask &= row_mask[rows][:, None]
+    if col_mask is not None:
+      mask &= col_mask[None, :]
+    ii, jj = np.nonzero(mask)
+    list_i.append(ii + c_start)
+    list_j.append(jj)
+    list_w.append(chunk[ii, jj])
+  if not list_i:
+    return (np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, block.dtype))
+  return (np.concatenate(list_i), np.concatenate(list_j), np.concatenate(list_w))
+
+
+def select_topk(block, start, k, sign='both', max_neg=0.0, min_pos=0.0, row_mask=None, col_mask=None, chunk_rows=1024):
+  """Select the k strongest partners of each gene in a row block of a correlation matrix.
+
+  For the gene start + i of each row, the k largest positive correlations at least min_pos
+  and/or (sign: 'pos', 'neg' or 'both') the k smallest negative correlations at most max_neg
+  are selected by partial selection (np.argpartition); the diagonal is excluded.
+  row_mask and col_mask (boolean arrays) restrict the genes of the rows and the columns.
+  Returns the arrays (i, j, weight) as select_edges does, but from the whole rows.
+  """
+  list_i, list_j, list_w = [], [], []
+  cols = np.arange(block.shape[1])
+  kk = min(k, block.shape[1])
+  for c_start in range(0, block.shape[0], chunk_rows):
+    chunk = np.asarray(block[c_start:c_start + chunk_rows], dtype=np.float64)
+    rows = np.arange(c_start, c_start + len(chunk))
+    valid = cols[None, :] != (start + rows)[:, None]
+    if row_mask is not None:
+      valid &= row_mask[rows][:, None]
+    if col_mask is not None:
+      valid &= col_mask[None, :]
+    candidates = []
+    if sign in ('pos', 'both'):
+      candidates.append(np.where(valid & (chunk > 0) & (chunk >= min_pos), -chunk, np.inf))
+    if sign in ('neg', 'both'):
+      candidates.append(np.where(valid & (chunk < 0) & (chunk <= max_neg), chunk, np.inf))
+    for key in candidates:
+      # the kk smallest keys of each row (in no particular order).
+      jj = np.argpartition(key, kk - 1, axis=1)[:, :kk]
+      ii = np.repeat(rows[:, None], kk, axis=1)
+      found = np.isfinite(np.take_along_axis(key, jj, axis=1))
+      list_i.append(ii[found])
+      list_j.append(jj[found])
+      list_w.append(chunk[ii[found] - c_start, jj[found]])
+  if not list_i:
+    return (np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64))
+  return (np.concatenate(list_i), np.concatenate(list_j), np.concatenate(list_w))
+
+
+def topk_from_edges(edge_i, edge_j, weight, k, sign='both', max_neg=0.0, min_pos=0.0, mask=None):
+  """Same as select_topk, but on an upper-triangle edge list (e.g., an .npz edge list).
+
+  Returns the arrays (i, j, weight) of the selected (gene, partner) pairs.
+  """
+  node = np.concatenate([edge_i, edge_j])
+  partner = np.concatenate([edge_j, edge_i])
+  w = np.concatenate([weight, weight]).astype(np.float64)
+  valid = node != partner
+  if mask is not None:
+    valid &= mask[node] & mask[partner]
+  list_i, list_j, list_w = [], [], []
+  keys = []
+  if sign in ('pos', 'both'):
+    keys.append((valid & (w > 0) & (w >= min_pos), -w))
+  if sign in ('neg', 'both'):
+    keys.append((valid & (w < 0) & (w <= max_neg), w))
+  for selected, key in keys:
+    idx = np.flatnonzero(selected)
+    # sort by gene, then by key; the rank of a pair is its position within its gene.
+    idx = idx[np.lexsort((key[idx], node[idx]))]
+    group_start = np.searchsorted(node[idx], node[idx], side='left')
+    idx = idx[np.arange(len(idx)) - group_start < k]
+    list_i.append(node[idx])
+    list_j.append(partner[idx])
+    list_w.append(w[idx])
+  return (np.concatenate(list_i), np.concatenate(list_j), np.concatenate(list_w))
+
+
+def unique_pairs(n, edge_i, edge_j, weight):
+  """Merge the pairs (i, j) and (j, i) into one upper-triangle pair, in row-major order."""
+  a = np.minimum(edge_i, edge_j).astype(np.int64)
+  b = np.maximum(edge_i, edge_j).astype(np.int64)
+  keys, first = np.unique(a * n + b, return_index=True)
+  return (a[first].astype(np.int32), b[first].astype(np.int32), weight[first])
+
+
+def extract_edges(blocks, max_neg, min_pos):
+  """Keep only the upper-triangle cells of the row blocks passing the thresholds.
+
+  A pair (i, j) with i < j survives if its correlation is at most max_neg or at least min_pos.
+  Returns the arrays (i, j, weight) of the surviving pairs.
+  """
+  list_i, list_j, list_w = [], [], []
+  for (start, stop, block) in blocks:
+    ii, jj, ww = select_edges(block, start, max_neg, min_pos)
+    list_i.append(ii + start)
+    list_j.append(jj)
+    list_w.append(ww)
+  if not list_i:
+    return (np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.float32))
+  # round to the 5 digits kept by construct_gcn.py before the cast, as the csv path does.
+  return (np.concatenate(list_i).astype(np.int32),
+          np.concatenate(list_j).astype(np.int32),
+          np.round(np.concatenate(list_w).astype(np.float64), 5).astype(np.float32))
+
+
+def save_edges(edge_file, genes, edge_i, edge_j, weight, max_neg, min_pos):
+  """Save an edge list (i, j, weight) cut at (max_neg, min_pos) with the gene names as an .npz file."""
+  np.savez(edge_file, genes=np.asarray(genes, dtype=str), i=edge_i, j=edge_j, weight=weight,
+           thresholds=np.array([max_neg, min_pos], dtype=np.float64))
+
+
+def load_edges(edge_file):
+  """Load an edge list saved by save_edges.
+
+  Returns (genes, i, j, weight).
+  """
+  with np.load(edge_file) as data:
+    return (data['genes'], data['i'], data['j'], data['weight'])
+
+
+def load_edge_thresholds(edge_file):
+  """The thresholds (max_neg, min_pos) an edge list was cut at, or None if it does not record them."""
+  with np.load(edge_file) as data:
+    if 'thresholds' not in data.files:
+      return None
+    return tuple(float(t) for t in data['thresholds'])
@@ -0,0 +1,112 @@
+__doc__ = (
+"""
+  Export a binary correlation store (.gcm) generated by compute_gcm.py with '-b' as a csv file.
+  Default output: "store_dir"/"store_prefix".csv
+
+usage:
+{f} <store> [-o <output_file>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  <store>                  specify the correlation store (.gcm directory).
+  -o <output_file>         specify the output file.
+""").format(f=__file__)
+
+import json
+import os
+import sys
+import numpy as np
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+import corr_engine
+
+# A correlation store is a directory containing
+#   matrix.npy: the gene x gene matrix (float32 or float64), memory-mapped by readers,
+#   genes.npy:  the gene names (the index of both rows and columns),
+#   meta.json:  the shape, the dtype and the number of rows of a chunk.
+# Readers process the matrix chunk by chunk (a chunk is a block of rows).
+matrix_filename = 'matrix.npy'
+genes_filename = 'genes.npy'
+meta_filename = 'meta.json'
+store_version = 1
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '<store>': Use(str),
+  Optional('-o'): Use(str),
+})
+
+def is_store(path):
+  return os.path.isdir(path) and os.path.exists(os.path.join(path, meta_filename))
+
+def write_store(store_path, blocks, genes, dtype=np.float64, chunk_rows=1000):
+  """Write the row blocks of a correlation matrix to a correlation store.
+
+  Parameters
+  ----------
+  store_path: the directory of the store (created if needed).
+  blocks: iterable of (start, stop, block), as given by corr_engine.iter_corr_blocks.
+  genes: the gene names.
+  dtype: the dtype of the stored matrix (float32 or float64).
+  chunk_rows: the number of rows of a chunk used by readers.
+  """
+  os.makedirs(store_path, exist_ok=True)
+  n = len(genes)
+  np.save(os.path.join(store_path, genes_filename), np.asarray(genes, dtype=str))
+  matrix = np.lib.format.open_memmap(os.path.join(store_path, matrix_filename), mode='w+', dtype=dtype, shape=(n, n))
+  for (start, stop, block) in blocks:
+    matrix[start:stop] = block
+  matrix.flush()
+  del matrix
+  meta = {'version': store_version, 'shape': [n, n], 'dtype': np.dtype(dtype).name, 'chunk_rows': int(chunk_rows)}
+  with open(os.path.join(store_path, meta_filename), 'w') as f:
+    json.dump(meta, f)
+
+def open_store(store_path):
+  """Open a correlation store.
+
+  Returns (genes, matrix, meta), where matrix is a read-only memory map,
+  so slicing rows loads only those rows.
+  """
+  with open(os.path.join(store_path, meta_filename)) as f:
+    meta = json.load(f)
+  genes = np.load(os.path.join(store_path, genes_filename))
+  matrix = np.load(os.path.join(store_path, matrix_filename), mmap_mode='r')
+  return (genes, matrix, meta)
+
+def iter_row_chunks(store_path, chunk_rows=0):
+  """Yield (start, stop, block) for the chunks of a correlation store.
+
+  chunk_rows overrides the number of rows of a chunk recorded in the store if it is positive.
+  """
+  genes, matrix, meta = open_store(store_path)
+  if chunk_rows <= 0:
+    chunk_rows = meta['chunk_rows']
+  n = len(genes)
+  for start in range(0, n, chunk_rows):
+    stop = min(start + chunk_rows, n)
+    yield (start, stop, np.asarray(matrix[start:stop]))
+
+def export_csv(store_path, csv_file):
+  genes, matrix, meta = open_store(store_path)
+  corr_engine.write_corr_csv(iter_row_chunks(store_path), genes, csv_file)
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  store_path = os.path.abspath(args['<store>'])
+  result_file = args['-o']
+  if result_file == 'None' or result_file == '':
+    result_file = os.path.splitext(store_path)[0] + '.csv'
+  print(result_file)
+  export_csv(store_path, result_file)
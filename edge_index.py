@@ -0,0 +1,173 @@
+__doc__ = (
+"""
+  Output the numbers of edges of the networks for a series of thresholds (|correlation|)
+  from an edge index (.gci) built by construct_gcn.py with '-I'.
+  Default output: "index_dir"/"index_prefix"_sweep.csv
+  (columns: threshold, positive, negative, total; an edge is positive if its correlation
+  is at least the threshold, and negative if it is at most -threshold.)
+
+usage:
+{f} <index> [-d <dict_file>] [-c] [-r <thresholds>] [-o <output_file>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  <index>                  specify the edge index (.gci directory).
+  -d <dict_file>           count only the edges between the vertices (see construct_gcn.py) of the dictionary file.
+  -c                       set circular coordinate flag (used with -d).
+  -r <thresholds>          specify the thresholds (comma-separated), or a range "<from>:<to>:<step>" [default: 0.5:1.0:0.05].
+  -o <output_file>         specify the output file.
+""").format(f=__file__)
+
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+# An edge index is a directory containing
+#   genes.npy:             the gene names,
+#   i.npy, j.npy:          the gene indices (i < j) of the upper-triangle pairs with |correlation| >= floor,
+#   weight.npy:            their correlations; the positive pairs come first in descending order,
+#                          followed by the negative pairs in ascending order,
+#   meta.json:             the floor, the numbers of the positive and negative pairs, the source,
+#                          and the fingerprint of the contents of the source.
+# A network of thresholds (max_neg, min_pos) as strict as the floor is a prefix of each part,
+# found by binary search. Every array is memory-mapped by readers.
+meta_filename = 'meta.json'
+index_version = 1
+index_ext = '.gci'
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '<index>': Use(str),
+  Optional('-d'): Use(str),
+  '-c': bool,
+  '-r': Use(str),
+  Optional('-o'): Use(str),
+})
+
+def is_index(path):
+  return os.path.isdir(path) and os.path.exists(os.path.join(path, meta_filename))
+
+def write_index(index_path, genes, edge_i, edge_j, weight, floor, source='', fingerprint=''):
+  """Write an edge index of the pairs (edge_i[k], edge_j[k]) with |weight[k]| >= floor.
+
+  source (the correlation data) and the fingerprint of its contents are recorded to detect a stale index.
+  """
+  os.makedirs(index_path, exist_ok=True)
+  weight = np.asarray(weight, dtype=np.float64)
+  keep = np.abs(weight) >= floor
+  edge_i, edge_j, weight = np.asarray(edge_i)[keep], np.asarray(edge_j)[keep], weight[keep]
+  pos = np.flatnonzero(weight > 0)
+  neg = np.flatnonzero(weight < 0)
+  order = np.concatenate([pos[np.argsort(-weight[pos], kind='stable')], neg[np.argsort(weight[neg], kind='stable')]])
+  arrays = {
+    'genes': np.asarray(genes, dtype=str),
+    'i': edge_i[order].astype(np.int32),
+    'j': edge_j[order].astype(np.int32),
+    'weight': weight[order],
+  }
+  for name, array in arrays.items():
+    np.save(os.path.join(index_path, name + '.npy'), array)
+  meta = {'version': index_version, 'floor': float(floor), 'positive': int(len(pos)), 'negative': int(len(neg)),
+          'source': os.path.abspath(source) if source else '', 'fingerprint': fingerprint}
+  with open(os.path.join(index_path, meta_filename), 'w') as f:
+    json.dump(meta, f)
+
+def open_index(index_path):
+  """Open an edge index. Returns (genes, i, j, weight, meta), where i, j and weight are memory-mapped."""
+  with open(os.path.join(index_path, meta_filename)) as f:
+    meta = json.load(f)
+  load = lambda name: np.load(os.path.join(index_path, name + '.npy'), mmap_mode='r')
+  genes = np.load(os.path.join(index_path, 'genes.npy'))
+  return (genes, load('i'), load('j'), load('weight'), meta)
+
+def is_fresh(index_path, fingerprint, floor):
+  """Whether the index exists, was built from the source of fingerprint as it is now, and covers |correlation| >= floor."""
+  if not is_index(index_path):
+    return False
+  genes, i, j, weight, meta = open_index(index_path)
+  return meta.get('fingerprint') == fingerprint and meta['floor'] <= floor
+
+def cut_points(weight, meta, max_neg, min_pos):
+  """The numbers of the positive pairs >= min_pos and the negative pairs <= max_neg in the index."""
+  n_pos = meta['positive']
+  k_pos = np.searchsorted(-weight[:n_pos], -min_pos, side='right')
+  k_neg = np.searchsorted(weight[n_pos:], max_neg, side='right')
+  return (int(k_pos), int(k_neg))
+
+def select_edges(index, max_neg, min_pos):
+  """Select the pairs at most max_neg or at least min_pos from an opened index (see open_index).
+
+  Returns (i, j, weight) in the row-major order of the upper triangle, as a scan of the matrix gives.
+  """
+  genes, i, j, weight, meta = index
+  if max_neg > -meta['floor'] or min_pos < meta['floor']:
+    raise ValueError('the thresholds ({0}, {1}) are looser than the floor of the index ({2})'.format(max_neg, min_pos, meta['floor']))
+  n_pos = meta['positive']
+  k_pos, k_neg = cut_points(weight, meta, max_neg, min_pos)
+  rows = np.r_[0:k_pos, n_pos:n_pos + k_neg]
+  edge_i, edge_j, edge_w = i[rows], j[rows], weight[rows]
+  order = np.lexsort((edge_j, edge_i))
+  return (edge_i[order], edge_j[order], edge_w[order])
+
+def threshold_sweep(index, thresholds, is_vertex=None):
+  """Count the edges of the networks of (max_neg, min_pos) = (-t, t) for t in thresholds.
+
+  If is_vertex (a mask of the genes) is given, only the edges between the masked genes are counted.
+  Returns a DataFrame with columns threshold, positive, negative and total.
+  """
+  genes, i, j, weight, meta = index
+  n_pos = meta['positive']
+  valid = np.ones(len(weight), dtype=bool) if is_vertex is None else is_vertex[i] & is_vertex[j]
+  # counts[k] is the number of valid pairs among the first k of each part.
+  pos_counts = np.concatenate([[0], np.cumsum(valid[:n_pos])])
+  neg_counts = np.concatenate([[0], np.cumsum(valid[n_pos:])])
+  positive, negative = [], []
+  for t in thresholds:
+    k_pos, k_neg = cut_points(weight, meta, -t, t)
+    positive.append(int(pos_counts[k_pos]))
+    negative.append(int(neg_counts[k_neg]))
+  df = pd.DataFrame({'threshold': thresholds, 'positive': positive, 'negative': negative})
+  df['total'] = df['positive'] + df['negative']
+  return df
+
+def parse_thresholds(text):
+  """Parse "t1,t2,..." or "<from>:<to>:<step>" (both ends included)."""
+  if ':' in text:
+    t_from, t_to, t_step = [float(s) for s in text.split(':')]
+    return np.round(np.arange(t_from, t_to + t_step / 2, t_step), 10).tolist()
+  return [float(s) for s in text.split(',')]
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  index_path = os.path.abspath(args['<index>'])
+  result_file = args['-o']
+  if result_file == 'None' or result_file == '':
+    result_file = os.path.splitext(index_path)[0] + '_sweep.csv'
+  print(result_file)
+  index = open_index(index_path)
+  print("{0} genes, {1} positive and {2} negative pairs (floor {3})".format(len(index[0]), index[4]['positive'],
+                                                                           index[4]['negative'], index[4]['floor']))
+  thresholds = [t for t in parse_thresholds(args['-r']) if t >= index[4]['floor']]
+  is_vertex = None
+  if args['-d'] != 'None':
+    import construct_gcn
+    gene_dict = construct_gcn.load_gene_dict(args['-d'])
+    is_vertex = np.isin(index[0], construct_gcn.vertex_table(index[0], gene_dict, args['-c']).index)
+  df = threshold_sweep(index, thresholds, is_vertex)
+  print(df)
+  df.to_csv(result_file, index=False)
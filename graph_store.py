@@ -0,0 +1,158 @@
+__doc__ = (
+"""
+  Convert a gene correlation graph between Pajek (.net) and the binary graph store (.gcg).
+  Default output: "data_dir"/"data_prefix".gcg for a .net file, "data_dir"/"data_prefix".net for a .gcg directory.
+
+usage:
+{f} <data_file> [-o <output_file>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  <data_file>              specify the graph file (.net) or the graph store (.gcg directory).
+  -o <output_file>         specify the output file.
+""").format(f=__file__)
+
+import json
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+import networkx as nx
+from mypajek import fast_read_pajek
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+# A graph store is a directory containing
+#   names.npy:   the names of the nodes,
+#   x.npy, y.npy: the coordinates of the nodes (NaN if missing),
+#   indptr.npy, indices.npy, weights.npy: the symmetric adjacency matrix in CSR
+#                (weights in float32; each edge appears in both directions),
+#   meta.json:   the numbers of nodes and edges.
+# Every array is memory-mapped by readers.
+meta_filename = 'meta.json'
+store_version = 1
+store_ext = '.gcg'
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '<data_file>': Use(str),
+  Optional('-o'): Use(str),
+})
+
+def is_store(path):
+  return os.path.isdir(path) and os.path.exists(os.path.join(path, meta_filename))
+
+def adjacency_from_edges(n, u, v, weight):
+  """The symmetric adjacency matrix (scipy CSR) of n nodes with the edges (u[k], v[k]) of weight[k]."""
+  u = np.asarray(u)
+  v = np.asarray(v)
+  weight = np.asarray(weight)
+  loop = u == v
+  rows = np.concatenate([u, v[~loop]])
+  cols = np.concatenate([v, u[~loop]])
+  return sp.csr_matrix((np.concatenate([weight, weight[~loop]]), (rows, cols)), shape=(n, n))
+
+def write_graph_arrays(store_path, names, x, y, u, v, weight):
+  """Write a graph given by arrays to a graph store.
+
+  Parameters
+  ----------
+  names: the names of the nodes.
+  x, y: the coordinates of the nodes.
+  u, v, weight: the edges (u[k], v[k]) given by node indices, and their weights.
+  """
+  os.makedirs(store_path, exist_ok=True)
+  n = len(names)
+  weight = np.asarray(weight, dtype=np.float32)
+  adj = adjacency_from_edges(n, u, v, weight)
+  adj.sort_indices()
+  index_dtype = np.int32 if adj.nnz < 2**31 else np.int64
+  arrays = {
+    'names': np.asarray(names, dtype=str),
+    'x': np.asarray(x, dtype=np.float64),
+    'y': np.asarray(y, dtype=np.float64),
+    'indptr': adj.indptr.astype(index_dtype),
+    'indices': adj.indices.astype(index_dtype),
+    'weights': adj.data.astype(np.float32),
+  }
+  for name, array in arrays.items():
+    np.save(os.path.join(store_path, name + '.npy'), array)
+  meta = {'version': store_version, 'nodes': n, 'edges': int(len(weight))}
+  with open(os.path.join(store_path, meta_filename), 'w') as f:
+    json.dump(meta, f)
+
+def write_graph_store(g, store_path):
+  """Write a networkx graph (nodes with 'x', 'y' and edges with 'weight') to a graph store."""
+  names = list(g.nodes)
+  index = {name: i for i, name in enumerate(names)}
+  x = [g.nodes[name].get('x', np.nan) for name in names]
+  y = [g.nodes[name].get('y', np.nan) for name in names]
+  u = np.fromiter((index[a] for a, b in g.edges), dtype=np.int64, count=g.number_of_edges())
+  v = np.fromiter((index[b] for a, b in g.edges), dtype=np.int64, count=g.number_of_edges())
+  weight = np.fromiter((d.get('weight', 1.0) for a, b, d in g.edges(data=True)), dtype=np.float64, count=g.number_of_edges())
+  write_graph_arrays(store_path, names, x, y, u, v, weight)
+
+def open_graph_store(store_path):
+  """Open a graph store without copying it.
+
+  Returns (names, x, y, adj), where adj is the symmetric adjacency matrix (scipy CSR)
+  on top of the memory-mapped arrays.
+  """
+  load = lambda name: np.load(os.path.join(store_path, name + '.npy'), mmap_mode='r')
+  names = np.load(os.path.join(store_path, 'names.npy'))
+  n = len(names)
+  adj = sp.csr_matrix((load('weights'), load('indices'), load('indptr')), shape=(n, n), copy=False)
+  return (names, load('x'), load('y'), adj)
+
+def load_adjacency(path):
+  """Load a graph (.gcg directory or .net file) as (names, x, y, adj) without building a networkx graph."""
+  if is_store(path):
+    return open_graph_store(path)
+  names, x, y, u, v, weight = fast_read_pajek(path, as_arrays=True)
+  return (names, x, y, adjacency_from_edges(len(names), u, v, weight))
+
+def store_to_graph(names, x, y, adj):
+  """Build a networkx graph from arrays given by open_graph_store.
+
+  The weights are rounded to 5 digits (as written by construct_gcn.py) to undo the float32 storage.
+  """
+  g = nx.Graph()
+  x = np.asarray(x).tolist()
+  y = np.asarray(y).tolist()
+  g.add_nodes_from((name, {'x': xi, 'y': yi}) for name, xi, yi in zip(names.tolist(), x, y))
+  upper = sp.triu(adj, format='coo')
+  weight = np.round(upper.data.astype(np.float64), 5)
+  g.add_weighted_edges_from(zip(names[upper.row].tolist(), names[upper.col].tolist(), weight.tolist()))
+  return g
+
+def load_graph(path):
+  """Load a graph from a graph store (.gcg directory) or a Pajek file (.net)."""
+  if is_store(path):
+    return store_to_graph(*open_graph_store(path))
+  return fast_read_pajek(path)
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  data_file = os.path.abspath(args['<data_file>'])
+  to_store = not is_store(data_file)
+  result_file = args['-o']
+  if result_file == 'None' or result_file == '':
+    result_file = os.path.splitext(data_file)[0] + (store_ext if to_store else '.net')
+  print(result_file)
+  g = load_graph(data_file)
+  if to_store:
+    write_graph_store(g, result_file)
+  else:
+    nx.write_pajek(g, result_file)
+  print("n = {0}, m = {1}".format(g.number_of_nodes(), g.number_of_edges()))
@@ -1,21 +1,34 @@
 __doc__ = (
 """ 
-  Find the top 10 largest clusters in the graph specified by <data_file>) by Louvain method.
+  Find the top <communities> largest clusters in the graph specified by <data_file>) by Louvain method.
   Default output: 
   "data_dir"/louvain_"data_prefix"_"idx".net,
   "data_dir"/louvain_"data_prefix"_"idx".png, and
   "data_dir"/louvain_"data_prefix"_rank".csv 
   where "idx" denotes the index of the cluster.
+  With -T, all the clusters are plotted in one figure "data_dir"/louvain_"data_prefix"_tiles.png.
+  With several resolutions (-R) or seeds (-n), Louvain method is run for each pair of them, and
+  "data_dir"/louvain_"data_prefix"_sweep.csv (modularity and stability of each run),
+  "data_dir"/louvain_"data_prefix"_sweep_ari.csv (adjusted Rand index between runs) and
+  "data_dir"/louvain_"data_prefix"_partition.csv (the consensus partition) are output as well.
+  The consensus partition is the run most similar (mean ARI) to the others, and its clusters are output.
   ('data_dir' is the directory of <data_file>, 'data_prefix' is the prefix of <data_file>) 
 usage:
-{f} <data_file> [-r] [-p] [-o <output_prefix>]
+{f} <data_file> [-r] [-p] [-T] [-R <resolutions>] [-n <seeds>] [-B <backend>] [-k <communities>] [-j <jobs>] [-o <output_prefix>]
 {f} -h | --help
 
 options:
   -h, --help               show this help message and exit.
-  <data_file>              specify the graph file (.net).
+  <data_file>              specify the graph file (.net) or the graph store (.gcg).
   -r                       generate the ranking for each cluster.
   -p                       generate the plot (.png) for each cluster.
+  -T                       generate the plot (.png) of all the clusters in one tiled figure.
+  -R <resolutions>         specify the resolutions (comma-separated) of Louvain method [default: 1.0].
+  -n <seeds>               specify the number of random seeds (0, 1, ...) per resolution [default: 1].
+  -B <backend>             specify the implementation of community detection: louvain (python-louvain),
+                           igraph (Louvain method of python-igraph) or leiden (leidenalg) [default: louvain].
+  -k <communities>         specify the number of the largest clusters to output (0: all) [default: 10].
+  -j <jobs>                specify the number of processes running Louvain method and exporting clusters [default: 1].
   -o <output_prefix>       specify the prefix of output file.
 """).format(f=__file__)
 
@@ -24,69 +37,297 @@ import community as community_louvain
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import os
+import random
 import sys
-import collections
-from mypajek import my_read_pajek
+from concurrent.futures import ProcessPoolExecutor
+from graph_store import load_graph
 import plot_gcn
 from docopt import docopt
 from schema import Schema, SchemaError, And, Or, Use, Optional
 
+# implementations of community detection; igraph and leiden run on a CSR adjacency
+# by compiled code and are imported only when selected.
+backends = ['louvain', 'igraph', 'leiden']
+
 # define the schema for args.
 schema = Schema({
   '--help': bool,
   '<data_file>': Use(str),
   Optional('-r'): bool,
   Optional('-p'): bool,
+  Optional('-T'): bool,
+  '-R': And(Use(lambda s: [float(r) for r in s.split(',')]), lambda l: all(0 < r for r in l), error="<resolutions> should be positive numbers"),
+  '-n': And(Use(int), lambda n: 0 < n),
+  '-B': And(Use(str), lambda s: s in backends, error="<backend> should be louvain, igraph or leiden"),
+  '-k': And(Use(int), lambda n: 0 <= n),
+  '-j': And(Use(int), lambda n: 0 < n),
   Optional('-o'): Use(str),
 })
 
 
 
-def louvain(G, output_prefix, ranking=False, plot=True):
+def absolute_graph(G):
     G_temp = G.copy()
     
     for (u,v,d) in G_temp.edges(data=True):
       d["weight"] = abs(d["weight"])
+    return G_temp
+
+
+def partition_csr(adj, backend='igraph', resolution=1.0, seed=0):
+    """Find communities of the graph given by a symmetric CSR adjacency (|weight|) by a compiled backend.
+
+    Returns the community label of each node (row of adj).
+    """
+    try:
+      import igraph
+    except ImportError:
+      raise ImportError("backend '{0}' requires python-igraph (pip install igraph)".format(backend))
+    upper = sp.triu(adj, format='coo')
+    g = igraph.Graph(n=adj.shape[0], edges=np.column_stack([upper.row, upper.col]).tolist(),
+                     edge_attrs={'weight': upper.data.tolist()})
+    if backend == 'leiden':
+      try:
+        import leidenalg
+      except ImportError:
+        raise ImportError("backend 'leiden' requires leidenalg (pip install leidenalg)")
+      part = leidenalg.find_partition(g, leidenalg.RBConfigurationVertexPartition, weights='weight',
+                                      resolution_parameter=resolution, seed=seed)
+      return np.array(part.membership)
+    # igraph draws random numbers from the random module.
+    random.seed(seed)
+    return np.array(g.community_multilevel(weights='weight', resolution=resolution).membership)
+
+
+def find_partition(G_temp, backend='louvain', resolution=1.0, seed=0, adj=None):
+    """Find communities of G_temp (|weight|) and return them as {node: label}.
+
+    adj (the CSR adjacency of G_temp in node order) is built if not given and backend is not louvain.
+    """
+    if backend == 'louvain':
+      return community_louvain.best_partition(G_temp, resolution=resolution, random_state=seed)
+    nodes = list(G_temp.nodes)
+    if adj is None:
+      adj = nx.to_scipy_sparse_array(G_temp, nodelist=nodes, weight='weight', format='csr')
+    return dict(zip(nodes, partition_csr(adj, backend, resolution, seed).tolist()))
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    """Adjusted Rand index between two partitions given as label arrays."""
+    labels_a = np.unique(labels_a, return_inverse=True)[1]
+    labels_b = np.unique(labels_b, return_inverse=True)[1]
+    n = len(labels_a)
+    pairs = lambda x: x * (x - 1) / 2.0
+    contingency = sp.coo_matrix((np.ones(n), (labels_a, labels_b))).tocsr()
+    sum_ab = pairs(contingency.data).sum()
+    sum_a = pairs(np.bincount(labels_a)).sum()
+    sum_b = pairs(np.bincount(labels_b)).sum()
+    expected = sum_a * sum_b / pairs(n) if n > 1 else 0.0
+    maximum = (sum_a + sum_b) / 2.0
+    if maximum == expected:
+      return 1.0
+    return (sum_ab - expected) / (maximum - expected)
+
+
+# shared by the runs in a worker process of the sweep.
+sweep_context = {}
+
+def init_sweep_worker(G_temp, backend='louvain'):
+    sweep_context['graph'] = G_temp
+    sweep_context['nodes'] = list(G_temp.nodes)
+    sweep_context['backend'] = backend
+    sweep_context['adj'] = None
+    if backend != 'louvain':
+      sweep_context['adj'] = nx.to_scipy_sparse_array(G_temp, nodelist=sweep_context['nodes'], weight='weight', format='csr')
+
+def run_louvain(resolution, seed):
+    G_temp = sweep_context['graph']
+    partition = find_partition(G_temp, sweep_context['backend'], resolution, seed, sweep_context['adj'])
+    labels = np.array([partition[v] for v in sweep_context['nodes']])
+    return (labels, community_louvain.modularity(partition, G_temp))
+
+
+def louvain_sweep(G, output_prefix, resolutions, n_seeds, jobs=1, backend='louvain'):
+    """Run Louvain method for each resolution and each seed (0, ..., n_seeds-1).
+
+    The runs are distributed over jobs processes, each of which receives the graph
+    with |weight| prepared once. The modularity of each run and the adjusted Rand
+    index (ARI) between runs are stored; the run with the largest mean ARI to the
+    others (ties are broken by modularity) is the consensus partition.
+    Returns (partition, G_temp) of the consensus run.
+    """
+    G_temp = absolute_graph(G)
+    nodes = list(G_temp.nodes)
+    runs = [(r, s) for r in resolutions for s in range(n_seeds)]
+    res_list = [r for r, s in runs]
+    seed_list = [s for r, s in runs]
+    if jobs > 1 and len(runs) > 1:
+      with ProcessPoolExecutor(max_workers=jobs, initializer=init_sweep_worker, initargs=(G_temp, backend)) as executor:
+        results = list(executor.map(run_louvain, res_list, seed_list))
+    else:
+      init_sweep_worker(G_temp, backend)
+      results = [run_louvain(r, s) for r, s in runs]
+
+    k = len(runs)
+    ari = np.ones((k, k))
+    for a in range(k):
+      for b in range(a+1, k):
+        ari[a, b] = ari[b, a] = adjusted_rand_index(results[a][0], results[b][0])
+    mean_ari = (ari.sum(axis=1) - 1) / (k - 1) if k > 1 else np.ones(1)
+    modularity = np.array([m for labels, m in results])
+    consensus = np.lexsort((-modularity, -mean_ari))[0]
+
+    names = ['r{0}_s{1}'.format(r, s) for r, s in runs]
+    summary = pd.DataFrame({'resolution': res_list, 'seed': seed_list,
+                            'communities': [len(np.unique(labels)) for labels, m in results],
+                            'modularity': modularity, 'mean ARI': mean_ari,
+                            'consensus': np.arange(k) == consensus}, index=names)
+    print(summary)
+    summary.to_csv(output_prefix + 'sweep.csv')
+    pd.DataFrame(ari, index=names, columns=names).to_csv(output_prefix + 'sweep_ari.csv')
+    labels = results[consensus][0]
+    print('consensus: resolution =', res_list[consensus], 'seed =', seed_list[consensus])
+    partition_file = output_prefix + 'partition.csv'
+    print('partition', partition_file)
+    pd.DataFrame({'Gene': nodes, 'community': labels}).to_csv(partition_file, index=False)
+    return (dict(zip(nodes, labels.tolist())), G_temp)
+
+
+def community_members(partition, n_communities=10):
+    """Invert a partition once into the node indices of its largest communities.
+
+    Communities are ordered by size (ties by first appearance in partition), and
+    the first n_communities of them (all if n_communities is 0) are returned as
+    arrays of indices into list(partition.keys()).
+    """
+    labels = np.fromiter(partition.values(), dtype=np.int64, count=len(partition))
+    uniq, first, inverse, counts = np.unique(labels, return_index=True, return_inverse=True, return_counts=True)
+    order = np.lexsort((first, -counts))
+    if n_communities > 0:
+      order = order[:n_communities]
+    rank = np.full(len(uniq), len(order))
+    rank[order] = np.arange(len(order))
+    node_rank = rank[inverse]
+    sorted_nodes = np.argsort(node_rank, kind='stable')
+    return np.split(sorted_nodes, np.cumsum(counts[order]))[:len(order)]
+
+
+def community_edges(G, nodes, members):
+    """Split the edges inside the given communities in one pass over the sparse adjacency.
+
+    Returns (u, v, weight) for each community of members, where u and v are indices
+    into the community (i.e., into members[k]).
+    """
+    n = len(nodes)
+    node_rank = np.full(n, len(members))
+    local = np.zeros(n, dtype=np.int64)
+    for k, part in enumerate(members):
+      node_rank[part] = k
+      local[part] = np.arange(len(part))
+    adj = sp.triu(nx.to_scipy_sparse_array(G, nodelist=nodes, weight='weight'), format='coo')
+    inside = (node_rank[adj.row] == node_rank[adj.col]) & (node_rank[adj.row] < len(members))
+    row, col, weight = adj.row[inside], adj.col[inside], adj.data[inside]
+    order = np.argsort(node_rank[row], kind='stable')
+    row, col, weight = row[order], col[order], weight[order]
+    bounds = np.searchsorted(node_rank[row], np.arange(len(members) + 1))
+    return [(local[row[a:b]], local[col[a:b]], weight[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def community_arrays(attrs, u, v, weight, nodesize=200):
+    """The arrays drawn by plot_gcn.render_gcn for a community (see plot_gcn.default_setting)."""
+    x = np.array([a['x'] for a in attrs], dtype=np.float64)
+    y = np.array([a['y'] for a in attrs], dtype=np.float64)
+    return (x, y, 'green', np.full(len(attrs), nodesize), u, v, weight)
+
+
+def export_community(idx, part_nodes, attrs, u, v, weight, output_prefix, ranking=False, plot=True):
+    """Write (and plot and rank) the community of index idx given by its nodes and edges.
+
+    Returns (idx, pr_nodes, pr_rank), the nodes sorted by PageRank (on |weight|)
+    if ranking is True.
+    """
+    H_origin = nx.Graph()
+    H_origin.add_nodes_from(zip(part_nodes, attrs))
+    H_origin.add_weighted_edges_from(zip([part_nodes[k] for k in u], [part_nodes[k] for k in v], weight.tolist()))
+    output_file = output_prefix + str(idx) + '.net'
+    print('output', output_file)
+    nx.write_pajek(H_origin, output_file)
+
+    if plot:
+      plot_file = output_prefix + str(idx) + '.png'
+      print('plot', plot_file)
+      plot_gcn.render_gcn(*community_arrays(attrs, u, v, weight), plot_file)
+
+    pr_nodes = []
+    pr_rank = []
+    if ranking:
+      H_temp = nx.Graph()
+      H_temp.add_nodes_from(part_nodes)
+      H_temp.add_weighted_edges_from(zip([part_nodes[k] for k in u], [part_nodes[k] for k in v], np.abs(weight).tolist()))
+      pr = nx.pagerank(H_temp, weight='weight')
+      pr = sorted(pr.items(), key=lambda x:x[1], reverse=True)
+      pr_nodes = [v for v,r in pr]
+      pr_rank = [r for v,r in pr]
+    return (idx, pr_nodes, pr_rank)
+
+
+def louvain(G, output_prefix, ranking=False, plot=True, partition=None, G_temp=None, n_communities=10, jobs=1, backend='louvain', tiled=False):
+    """Find communities of G by Louvain method of backend (unless partition is given) and export the largest ones.
+
+    The largest n_communities communities (all if 0) are output as .net files
+    (and plotted and ranked), distributed over jobs processes.
+    If tiled is True, all of them are also plotted in one figure.
+    """
+    if G_temp is None:
+      G_temp = absolute_graph(G)
     
-    partition = community_louvain.best_partition(G_temp, random_state=0)
-    
-    part_values = list(partition.values())
-    part_size = collections.Counter(part_values).most_common()
+    if partition is None:
+      partition = find_partition(G_temp, backend, seed=0)
     
-    print(len(part_size), "communites found")
+    print(len(set(partition.values())), "communites found")
     print("modularity =", community_louvain.modularity(partition, G_temp))
-    #print(part_size)
 
-    part_dict = dict() # for ranking data
+    nodes = list(partition.keys())
+    members = community_members(partition, n_communities)
+    subgraphs = community_edges(G, nodes, members)
 
-    idx_max = 10 if len(part_size) > 10 else len(part_size)
-    for i in range(idx_max):
-      part_num = part_size[i][0]
-      part_nodes = [v for v, p in partition.items() if p == part_num]
-      if len(part_nodes) > 1:
-        H_origin = nx.subgraph(G, part_nodes)
-        output_file = output_prefix + str(i+1) + '.net'
-        print('output', output_file)
-        nx.write_pajek(H_origin, output_file)
-
-        if plot:
-          plot_file = output_prefix + str(i+1) + '.png'
-          plot_gcn.default_setting(H_origin)
-          print('plot', plot_file)
-          plot_gcn.plot_gcn(H_origin, plot_file)
-        
-        if ranking:
-          H_temp = nx.subgraph(G_temp, part_nodes)
-          pr = nx.pagerank(H_temp, weight='weight')
-          pr = sorted(pr.items(), key=lambda x:x[1], reverse=True)
-          pr_nodes = [v for v,r in pr]
-          pr_rank = [r for v,r in pr]
-          part_dict["part"+str(i+1)] = pr_nodes
-          part_dict["part"+str(i+1)+" PageRank"] = pr_rank
+    tasks = []
+    for i, (part, (u, v, weight)) in enumerate(zip(members, subgraphs)):
+      if len(part) > 1:
+        part_nodes = [nodes[k] for k in part]
+        attrs = [G.nodes[n] for n in part_nodes]
+        tasks.append((i+1, part_nodes, attrs, u, v, weight))
+    
+    tiles = []
+    if tiled and len(tasks) > 0:
+      tile_file = output_prefix + 'tiles.png'
+      print('plot', tile_file)
+      graphs = [community_arrays(attrs, u, v, weight, nodesize=20) for (idx, part_nodes, attrs, u, v, weight) in tasks]
+      titles = ['{0} ({1} genes)'.format(task[0], len(task[1])) for task in tasks]
+      tiles = [(graphs, titles, tile_file)]
+
+    part_dict = dict() # for ranking data
+    if jobs > 1 and len(tasks) + len(tiles) > 1:
+      # each worker renders by the Agg backend set by plot_gcn, and closes its figures.
+      with ProcessPoolExecutor(max_workers=jobs) as executor:
+        tile_futures = [executor.submit(plot_gcn.render_tiles, *tile) for tile in tiles]
+        futures = [executor.submit(export_community, *task, output_prefix=output_prefix, ranking=ranking, plot=plot) for task in tasks]
+        results = [future.result() for future in futures]
+        for future in tile_futures:
+          future.result()
+    else:
+      for tile in tiles:
+        plot_gcn.render_tiles(*tile)
+      results = [export_community(*task, output_prefix=output_prefix, ranking=ranking, plot=plot) for task in tasks]
     
     if ranking:
+      for (idx, pr_nodes, pr_rank) in results:
+        part_dict["part"+str(idx)] = pr_nodes
+        part_dict["part"+str(idx)+" PageRank"] = pr_rank
       df = pd.DataFrame(part_dict.values(), index=part_dict.keys()).T
       ranking_file = output_prefix + 'rank.csv'
       print('ranking', ranking_file)
@@ -114,8 +355,15 @@ if __name__ == '__main__':
   if output_prefix == 'None' or output_prefix == '':
     output_prefix = data_dir + '/louvain_' + data_file_without_ext + '_'
   
-  G = nx.Graph(my_read_pajek(data_file))
+  G = load_graph(data_file)
   print(nx.number_of_nodes(G), 'nodes')
-  partition = louvain(G, output_prefix, ranking=args['-r'], plot=args['-p'])
+  partition = None
+  G_temp = None
+  if len(args['-R']) > 1 or args['-n'] > 1:
+    partition, G_temp = louvain_sweep(G, output_prefix, args['-R'], args['-n'], args['-j'], args['-B'])
+  elif args['-R'][0] != 1.0:
+    G_temp = absolute_graph(G)
+    partition = find_partition(G_temp, args['-B'], args['-R'][0], seed=0)
+  partition = louvain(G, output_prefix, ranking=args['-r'], plot=args['-p'], partition=partition, G_temp=G_temp, n_communities=args['-k'], jobs=args['-j'], backend=args['-B'], tiled=args['-T'])
 
   
\ No newline at end of file
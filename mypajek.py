@@ -1,3 +1,6 @@
+import shlex
+import numpy as np
+import pandas as pd
 import networkx as nx
 
 def my_parse_pajek(lines, encoding):
@@ -17,8 +20,6 @@ def my_parse_pajek(lines, encoding):
     read_pajek()
 
     """
-    import shlex
-
     # multigraph=False
     if isinstance(lines, str):
         lines = iter(lines.split("\n"))
@@ -158,3 +159,100 @@ def my_read_pajek(path, encoding="UTF-8"):
 
 
 
+def _parse_vertex_line(line):
+    if '"' in line:
+        return shlex.split(line)
+    return line.split()
+
+def fast_read_pajek(path, encoding="UTF-8", as_arrays=False):
+    """Read an undirected graph in Pajek format from path, as written by nx.write_pajek.
+
+    The *vertices block is split line by line (shlex is used only for quoted
+    lines), and the *edges block is parsed in bulk as columns.
+    A *network line gives the name of the graph, as in my_read_pajek.
+    Files that do not have this simple form (*arcs, *matrix, edge attributes,
+    missing weights, ...) are read by my_read_pajek instead.
+
+    Parameters
+    ----------
+    path : string
+       Filename to read.
+    encoding : encoding of the file
+    as_arrays : if True, return arrays instead of a graph.
+
+    Returns
+    -------
+    G : NetworkX Graph (as nx.Graph(my_read_pajek(path))), or
+    (labels, x, y, u, v, weight) if as_arrays is True, where u and v are
+    the indices of the end vertices of the edges in labels, and x and y
+    are NaN for vertices without coordinates.
+    """
+    with open(path, 'r', encoding=encoding) as f:
+        vertices = None
+        name = None
+        line = f.readline()
+        while line:
+            head = line.lower()
+            if head.startswith("*network"):
+                fields = line.rstrip("\n").split(None, 1)
+                if len(fields) == 2:
+                    name = fields[1]
+            elif head.startswith("*vertices"):
+                nnodes = int(line.split()[1])
+                vertices = [_parse_vertex_line(f.readline()) for i in range(nnodes)]
+            elif head.startswith("*edges"):
+                break
+            elif head.startswith("*") or (vertices is None and line.strip()):
+                # not written by nx.write_pajek
+                vertices = None
+                break
+            line = f.readline()
+        if vertices is None or not line or any(len(s) < 2 for s in vertices):
+            return _slow_read_pajek(path, encoding, as_arrays)
+        try:
+            edges = pd.read_csv(f, sep=r'\s+', header=None, names=['u', 'v', 'weight'],
+                                dtype={'u': np.int64, 'v': np.int64, 'weight': np.float64},
+                                float_precision='round_trip', comment=None)
+        except pd.errors.EmptyDataError:
+            edges = pd.DataFrame({'u': np.empty(0, np.int64), 'v': np.empty(0, np.int64), 'weight': np.empty(0)})
+        except (ValueError, pd.errors.ParserError):
+            return _slow_read_pajek(path, encoding, as_arrays)
+    if edges['weight'].isna().any():
+        return _slow_read_pajek(path, encoding, as_arrays)
+    ids = pd.Index([int(s[0]) for s in vertices])
+    u = ids.get_indexer(edges['u'].to_numpy())
+    v = ids.get_indexer(edges['v'].to_numpy())
+    if (u < 0).any() or (v < 0).any() or not ids.is_unique:
+        return _slow_read_pajek(path, encoding, as_arrays)
+    labels = np.array([s[1] for s in vertices], dtype=object)
+    weight = edges['weight'].to_numpy()
+    if as_arrays:
+        x = np.array([float(s[2]) if len(s) > 3 else np.nan for s in vertices])
+        y = np.array([float(s[3]) if len(s) > 3 else np.nan for s in vertices])
+        return (labels, x, y, u, v, weight)
+    G = nx.Graph()
+    if name is not None:
+        G.graph["name"] = name
+    for s in vertices:
+        attr = {"id": s[0]}
+        if len(s) > 3:
+            attr.update({"x": float(s[2]), "y": float(s[3])})
+        if len(s) > 4:
+            attr.update({"shape": s[4]})
+        attr.update(zip(s[5::2], s[6::2]))
+        G.add_node(s[1], **attr)
+    G.add_weighted_edges_from(zip(labels[u], labels[v], weight.tolist()))
+    return G
+
+def _slow_read_pajek(path, encoding, as_arrays):
+    G = nx.Graph(my_read_pajek(path, encoding))
+    if not as_arrays:
+        return G
+    labels = np.array(list(G.nodes), dtype=object)
+    index = {n: i for i, n in enumerate(labels)}
+    x = np.array([G.nodes[n].get("x", np.nan) for n in labels], dtype=np.float64)
+    y = np.array([G.nodes[n].get("y", np.nan) for n in labels], dtype=np.float64)
+    u = np.array([index[a] for a, b in G.edges], dtype=np.int64)
+    v = np.array([index[b] for a, b in G.edges], dtype=np.int64)
+    weight = np.array([d.get("weight", 1.0) for a, b, d in G.edges(data=True)], dtype=np.float64)
+    return (labels, x, y, u, v, weight)
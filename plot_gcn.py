@@ -7,14 +7,15 @@ __doc__ = (
   (if size is 0, the gene is removed)
   
 usage:
-{f} <data_file> [-s <setting_file>] [-e|-pdf] [-o <output_file>]
+{f} <data_file> [-s <setting_file>] [-e|--pdf] [-m <max_edges>] [-o <output_file>]
 {f} -h | --help
 
 options:
   -h, --help               show this help message and exit.
-  <data_file>              specify the graph file (.net).
+  <data_file>              specify the graph file (.net) or the graph store (.gcg).
   -e                       output eps file.
-  -pdf                     output pdf file.
+  --pdf                    output pdf file.
+  -m <max_edges>           draw only <max_edges> edges of the largest absolute weights (0: all edges) [default: 0].
   -s <setting_file>        use a setting CSV file.
   -o <output_file>         specify the output file.
 """).format(f=__file__)
@@ -22,9 +23,13 @@ options:
 import numpy as np
 import pandas as pd
 import networkx as nx
+import scipy.sparse as sp
 import matplotlib
+# render without a display.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from mypajek import my_read_pajek
+from matplotlib.collections import LineCollection
+from graph_store import load_adjacency
 import os
 import sys
 from docopt import docopt
@@ -35,84 +40,166 @@ schema = Schema({
   '--help': bool,
   '<data_file>': Use(str),
   '-e': bool,
-  '-pdf': bool,
+  '--pdf': bool,
+  '-m': And(Use(int), lambda n: 0 <= n),
   Optional('-s'): Use(str),
   Optional('-o'): Use(str),
 })
 
-def plot_gcn(g, plot_filename, node_color='green', map_node_edge=True):
-    edge_width = [ abs(d["weight"])*0.5 for (u,v,d) in g.edges(data=True)]
-    cm = plt.get_cmap('Blues')
-    cm_interval = [ i+1 / 10 for i in range(10)]
-    cm = cm(cm_interval)
-    #print(cm)
-    cmr = plt.get_cmap('Reds')
-    cmr = cmr(cm_interval)
-    edge_color = [ 'blue' if d["weight"] > 0 else 'red' for (u,v,d) in g.edges(data=True)]
-    #edge_color = [ cm[int((d["weight"] - 0.9)/0.01)] if d["weight"] > 0 else cmr[int((-0.8 - d["weight"])/0.02)] for (u,v,d) in g.edges(data=True)]
-    #edge_alpha = [ 1.0 if d["weight"] > 0 else 0.0 for (u,v,d) in g.edges(data=True)]
-    node_pos = {k: (d['x'], d['y']) for k, d in g.nodes(data=True)}
-    node_color = [ g.nodes[v]['color'] for v in g.nodes() ]
-    node_size = [ g.nodes[v]['size'] for v in g.nodes() ]
-    
-    plt.figure(figsize=(12, 12))
-    #plt.text(0.5, 1.1, r'1')
-    nx.draw(g,
-            pos = node_pos,
-            node_color=node_color,
-            node_size=node_size,
-            #edge_cmap=plt.cm.Greys,
-            edge_color=edge_color,
-            #edge_alpha=edge_alpha,
-            edge_vmin=-3e4,
-            width=edge_width,
-            with_labels=False,
-            font_size=16,
-            font_color='black')
-    
-    plt.savefig(plot_filename, dpi=300)
+# the extensions of vector outputs, in which the edges are rasterized
+# if there are more than raster_min_edges edges.
+vector_exts = ['.eps', '.pdf', '.ps', '.svg']
+raster_min_edges = 20000
+
+def graph_arrays(g):
+  """Build the arrays drawn by render_gcn from a graph.
+
+  Returns (x, y, node_color, node_size, u, v, weight); u and v are node indices of the edges.
+  Missing 'color' and 'size' of nodes are given as 'green' and 200 (see default_setting).
+  """
+  names = list(g.nodes)
+  n = len(names)
+  nodes = g.nodes
+  x = np.fromiter((nodes[k]['x'] for k in names), dtype=np.float64, count=n)
+  y = np.fromiter((nodes[k]['y'] for k in names), dtype=np.float64, count=n)
+  node_color = [nodes[k].get('color', 'green') for k in names]
+  node_size = np.fromiter((nodes[k].get('size', 200) for k in names), dtype=np.float64, count=n)
+  upper = sp.triu(nx.to_scipy_sparse_array(g, nodelist=names, weight='weight'), format='coo')
+  return (x, y, node_color, node_size, upper.row, upper.col, upper.data)
+
+def decimate_edges(weight, max_edges):
+  """Indices of the max_edges edges of the largest |weight| (all edges if max_edges is 0)."""
+  if max_edges <= 0 or len(weight) <= max_edges:
+    return np.arange(len(weight))
+  return np.sort(np.argpartition(-np.abs(weight), max_edges - 1)[:max_edges])
+
+def draw_gcn(ax, x, y, node_color, node_size, u, v, weight, max_edges=0, rasterized=False):
+  """Draw a graph given by arrays on ax.
+
+  The edges (width |weight|*0.5, blue if positive, red otherwise) are drawn as one LineCollection.
+  If max_edges > 0, only the max_edges edges of the largest |weight| are drawn.
+  """
+  keep = decimate_edges(weight, max_edges)
+  u, v, weight = np.asarray(u)[keep], np.asarray(v)[keep], np.asarray(weight)[keep]
+  pos = np.column_stack([x, y])
+  segments = np.stack([pos[u], pos[v]], axis=1)
+  edge_color = np.where((weight > 0)[:, None], matplotlib.colors.to_rgba('blue'), matplotlib.colors.to_rgba('red'))
+  edges = LineCollection(segments, linewidths=np.abs(weight)*0.5, colors=edge_color,
+                         antialiaseds=(1,), linestyle='solid', zorder=1, rasterized=rasterized)
+  ax.add_collection(edges)
+  ax.scatter(pos[:, 0], pos[:, 1], s=node_size, c=node_color, marker='o', zorder=2)
+  # pad the limits by 5% as networkx does.
+  corners = segments.reshape(-1, 2) if len(segments) > 0 else pos
+  (minx, miny), (maxx, maxy) = np.nanmin(corners, axis=0), np.nanmax(corners, axis=0)
+  pad = 0.05 * max(maxx - minx, maxy - miny)
+  ax.update_datalim(((minx - pad, miny - pad), (maxx + pad, maxy + pad)))
+  ax.autoscale_view()
+  ax.set_axis_off()
+
+def render_gcn(x, y, node_color, node_size, u, v, weight, plot_filename, max_edges=0):
+  """Draw a graph given by arrays (see draw_gcn) and save it to plot_filename.
+
+  The edges are rasterized in vector outputs (.eps, .pdf, .ps, .svg) of many edges.
+  """
+  n_edges = len(weight) if max_edges <= 0 else min(len(weight), max_edges)
+  is_raster = os.path.splitext(plot_filename)[1].lower() in vector_exts and n_edges > raster_min_edges
+  fig = plt.figure(figsize=(12, 12))
+  fig.set_facecolor('w')
+  ax = fig.add_axes((0, 0, 1, 1))
+  draw_gcn(ax, x, y, node_color, node_size, u, v, weight, max_edges, rasterized=is_raster)
+  fig.savefig(plot_filename, dpi=300)
+  plt.close(fig)
+
+def render_tiles(graphs, titles, plot_filename, tile_size=3, max_edges=0):
+  """Draw several graphs given by arrays (x, y, node_color, node_size, u, v, weight) in one tiled figure.
+
+  Each graph is drawn in a tile of tile_size x tile_size inches titled by titles.
+  """
+  columns = int(np.ceil(np.sqrt(len(graphs))))
+  rows = int(np.ceil(len(graphs) / columns))
+  fig, axes = plt.subplots(rows, columns, figsize=(tile_size*columns, tile_size*rows), squeeze=False)
+  fig.set_facecolor('w')
+  for ax in axes.ravel()[len(graphs):]:
+    ax.set_axis_off()
+  for ax, arrays, title in zip(axes.ravel(), graphs, titles):
+    draw_gcn(ax, *arrays, max_edges=max_edges)
+    ax.set_title(title)
+  fig.tight_layout()
+  fig.savefig(plot_filename, dpi=150)
+  plt.close(fig)
+
+def plot_gcn(g, plot_filename, node_color='green', map_node_edge=True, max_edges=0):
+    render_gcn(*graph_arrays(g), plot_filename, max_edges=max_edges)
 
 
 def default_setting(g, nodesize = 200, color = 'green'):
-  for v in g.nodes():
-    g.nodes[v]['color'] = 'green'
-    g.nodes[v]['size'] = nodesize
+  nx.set_node_attributes(g, color, 'color')
+  nx.set_node_attributes(g, nodesize, 'size')
 
 
 
-def custom_setting(g, setting_df):
-  genes = set(g.nodes.keys())
-  print(len(genes))
+def setting_table(names, setting_df, node_color, node_size):
+  """Join a setting table (columns gene, size, color) against the nodes.
+
+  The row of the gene 'default' gives the size and color of the genes not listed in the table.
+  node_color and node_size are the current attributes of the nodes (used if there is no 'default' row).
+  Returns (node_color, node_size, is_listed, is_removed, default_size): is_listed marks the genes listed
+  with a positive size, and is_removed those listed with size 0.
+  """
+  n = len(names)
+  is_default = (setting_df['gene'] == 'default').to_numpy()
+  node_color = np.array(np.broadcast_to(np.asarray(node_color, dtype=object), n))
+  node_size = np.array(np.broadcast_to(np.asarray(node_size, dtype=np.float64), n))
   default_size = 100
-  try:
-    for index, row in setting_df.iterrows():
-      gene = row['gene']
-      #print(gene)
-      if gene == 'default':
-        default_size = row['size']
-        default_setting(g, default_size, row['color'])
-      else:
-        size = int(row['size'])
-        v = g.nodes[gene]
-
-        if size == 0:
-          g.remove_node(gene)
-        else:
-          genes.remove(gene)
-          v['size'] = size
-          v['color'] = row['color']
-          #print(v)
-  except Exception as error:
-      print('setting file error at row {0}:{1}'.format(index, row))
-      raise error
-  print(len(genes))
+  if is_default.any():
+    default_row = setting_df[is_default].iloc[-1]
+    default_size = default_row['size']
+    node_color[:] = default_row['color']
+    node_size[:] = default_size
+  rows = setting_df[~is_default]
+  pos = pd.Index(names).get_indexer(rows['gene'])
+  if (pos < 0).any():
+    index = rows.index[np.argmax(pos < 0)]
+    print('setting file error at row {0}:{1}'.format(index, setting_df.loc[index]))
+    raise KeyError(setting_df.loc[index, 'gene'])
+  size = rows['size'].to_numpy().astype(int)
+  node_color[pos] = rows['color'].to_numpy()
+  node_size[pos] = size
+  is_listed = np.zeros(n, dtype=bool)
+  is_listed[pos[size != 0]] = True
+  is_removed = np.zeros(n, dtype=bool)
+  is_removed[pos[size == 0]] = True
+  print(n, 'genes,', int(is_listed.sum()), 'listed,', int(is_removed.sum()), 'removed')
+  return (node_color, node_size, is_listed, is_removed, default_size)
+
+def custom_setting(g, setting_df):
+  """Apply a setting table to the nodes of g (see setting_table).
+
+  The nodes of size 0 are removed; if the default size is 0, so are the edges of the genes not listed.
+  """
+  names = np.array(list(g.nodes), dtype=object)
+  node_color = [g.nodes[v].get('color', 'green') for v in names]
+  node_size = [g.nodes[v].get('size', 200) for v in names]
+  node_color, node_size, is_listed, is_removed, default_size = setting_table(names, setting_df, node_color, node_size)
+  nx.set_node_attributes(g, dict(zip(names, node_color)), 'color')
+  nx.set_node_attributes(g, dict(zip(names, node_size.tolist())), 'size')
   if default_size == 0:
-    edges = []
-    for v in genes:
-      #print(g.edges(v))
-      edges.extend(list(g.edges(v)))
-    #print(edges)
-    g.remove_edges_from(edges)
+    g.remove_edges_from(list(g.edges(names[~is_listed & ~is_removed])))
+  g.remove_nodes_from(names[is_removed])
+
+def apply_setting(names, x, y, u, v, weight, setting_df, node_color='green', node_size=200):
+  """Apply a setting table to a graph given by arrays (see setting_table and custom_setting).
+
+  Returns the arrays (x, y, node_color, node_size, u, v, weight) of render_gcn.
+  """
+  node_color, node_size, is_listed, is_removed, default_size = setting_table(names, setting_df, node_color, node_size)
+  keep_edge = ~is_removed[u] & ~is_removed[v]
+  if default_size == 0:
+    keep_edge &= is_listed[u] & is_listed[v]
+  keep = ~is_removed
+  new_index = np.cumsum(keep) - 1
+  return (np.asarray(x)[keep], np.asarray(y)[keep], node_color[keep], node_size[keep],
+          new_index[u[keep_edge]], new_index[v[keep_edge]], weight[keep_edge])
 
 
 
@@ -134,18 +221,20 @@ if __name__ == '__main__':
     ext = '.png'
     if args['-e']:
       ext = '.eps'
-    elif args['-pdf']:
+    elif args['--pdf']:
       ext = '.pdf'
     result_file = data_dir + '/' + data_file_without_ext + ext 
   
   
-  g = nx.Graph(my_read_pajek(data_file))
-  default_setting(g)
+  print(result_file)
+  # draw the arrays of the graph file without building a graph.
+  names, x, y, adj = load_adjacency(data_file)
+  upper = sp.triu(adj, format='coo')
+  arrays = (np.asarray(x), np.asarray(y), 'green', np.full(len(names), 200), upper.row, upper.col, upper.data.astype(np.float64))
   if args['-s'] != 'None':
     df = pd.read_csv(args['-s'])
-    custom_setting(g, df)
-  
-  plot_gcn(g, result_file)
+    arrays = apply_setting(names, *arrays[:2], *arrays[4:], df)
+  render_gcn(*arrays, result_file, max_edges=args['-m'])
 
   
 
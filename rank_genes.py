@@ -2,24 +2,37 @@ __doc__ = (
 """ 
   Rank genes (the nodes) of a gene correlation graph.
   Default output: "data_dir"/"data_prefix"_rank.csv 
+  ("data_dir"/"data_prefix"_ppr.csv with '-P', one column per gene in <gene_file>)
   ('data_dir' is the directory of <data_file>, 'data_prefix' is the prefix of <data_file>)
 usage:
-{f} <data_file> [-p <gene>] [-o <output_file>]
+{f} <data_file> [-p <gene>] [-M <metrics>] [-t <tol>] [-i <max_iter>] [-o <output_file>]
+{f} <data_file> -P <gene_file> [-j <jobs>] [-t <tol>] [-i <max_iter>] [-o <output_file>]
 {f} -h | --help
 
 options:
   -h, --help               show this help message and exit.
-  <data_file>              specify the graph file (.net).
-  -p <gene>                (work in progress) 
+  <data_file>              specify the graph file (.net) or the graph store (.gcg).
+  -p <gene>                compute PageRank personalized to <gene> (using weight) as well.
+  -M <metrics>             specify the metrics (comma-separated) among degree, weighted_degree,
+                           pos_degree, neg_degree, pagerank, pagerank_weight, eigenvector, kcore
+                           [default: degree,pagerank,pagerank_weight].
+  -P <gene_file>           compute PageRank personalized to each gene listed in <gene_file> (one gene per line).
+  -j <jobs>                specify the number of processes for '-P' [default: 1].
+  -t <tol>                 specify the error tolerance of PageRank [default: 1e-06].
+  -i <max_iter>            specify the maximum number of iterations of PageRank [default: 100].
   -o <output_file>         specify the output file.
 """).format(f=__file__)
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigsh
 import networkx as nx
-from mypajek import my_read_pajek
+from graph_store import load_adjacency
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt
 from schema import Schema, SchemaError, And, Or, Use, Optional
 
@@ -29,39 +42,282 @@ schema = Schema({
   '--help': bool,
   '<data_file>': Use(str),
   Optional('-p'): Use(str),
+  Optional('-P'): Use(str),
+  '-M': And(Use(lambda s: s.split(',')), lambda l: all(m in metrics for m in l), error="unknown metric in <metrics>"),
+  '-j': And(Use(int), lambda n: 0 < n),
+  '-t': And(Use(float), lambda n: 0 < n),
+  '-i': And(Use(int), lambda n: 0 < n),
   Optional('-o'): Use(str),
 })
 
+# damping factor of PageRank (same as nx.pagerank)
+alpha = 0.85
+# the number of personalization vectors solved together by a task of '-P'
+ppr_batch = 64
+
+def transition_matrix(adj):
+  """Normalize the rows of a non-negative adjacency matrix (scipy sparse).
+
+  Returns (Q, is_dangling), where is_dangling marks the rows without out-going weight.
+  """
+  out_weight = np.asarray(adj.sum(axis=1)).ravel()
+  inv = np.divide(1.0, out_weight, out=np.zeros_like(out_weight, dtype=np.float64), where=out_weight != 0)
+  return ((sp.diags(inv) @ adj).tocsr(), out_weight == 0)
+
+def pagerank_power(Q, is_dangling, personalization, tol=1e-06, max_iter=100):
+  """Solve PageRank for all columns of personalization at once by power iteration.
+
+  This is the iteration of nx.pagerank (uniform start, dangling nodes jump by the
+  personalization) applied to the n x k matrix of the k personalization vectors,
+  so the transition matrix is scanned once per iteration for all of them.
+  A column stops when the sum of its changes is less than n * tol.
+  Parameters
+  ----------
+  Q, is_dangling: the transition matrix given by transition_matrix.
+  personalization: n x k array (each column is normalized).
+  Returns
+  -------
+  (X, iterations, converged): n x k PageRank values, and the number of iterations
+  and the convergence flag of each column.
+  """
+  n, k = personalization.shape
+  if n == 0:
+    # an empty graph has nothing to rank.
+    return (np.zeros((0, k)), np.zeros(k, dtype=int), np.ones(k, dtype=bool))
+  P = personalization / personalization.sum(axis=0)
+  QT = Q.T.tocsr()
+  X = np.full((n, k), 1.0 / n)
+  iterations = np.zeros(k, dtype=int)
+  converged = np.zeros(k, dtype=bool)
+  active = np.arange(k)
+  for it in range(1, max_iter + 1):
+    Xa = X[:, active]
+    Pa = P[:, active]
+    Xn = alpha * (QT @ Xa + Xa[is_dangling].sum(axis=0) * Pa) + (1 - alpha) * Pa
+    err = np.abs(Xn - Xa).sum(axis=0)
+    X[:, active] = Xn
+    iterations[active] = it
+    done = err < n * tol
+    converged[active[done]] = True
+    active = active[~done]
+    if len(active) == 0:
+      break
+  return (X, iterations, converged)
+
+def report_convergence(name, iterations, converged):
+  for i, (it, conv) in enumerate(zip(iterations, converged)):
+    print('{0}: {1} iterations, {2}'.format(name, it, 'converged' if conv else 'NOT converged'))
+
 def negative_pagerank(g):
-  g1 = g.copy()
-  for u, v in g1.edges:
-    g1.edges[u, v]['weight'] = abs(g1.edges[u, v]['weight'])
-  return nx.pagerank(g1, weight='weight')
+  """PageRank using the absolute values of the weights."""
+  adj = abs(nx.to_scipy_sparse_array(g, weight='weight', format='csr'))
+  X, iterations, converged = pagerank_power(*transition_matrix(adj), np.ones((adj.shape[0], 1)))
+  return dict(zip(g.nodes, X[:, 0]))
+
+# Metrics of ranking.
+# Each metric is computed from a context (a dict) holding the adjacency matrix and the
+# options; intermediate results shared by several metrics (degree vectors, transition
+# matrices, ...) are computed once and kept in the context by shared().
+
+def shared(ctx, name, compute):
+  if name not in ctx:
+    ctx[name] = compute(ctx)
+  return ctx[name]
+
+def pattern_matrix(ctx):
+  pattern = ctx['adj'].copy()
+  pattern.data = np.ones_like(pattern.data, dtype=np.float64)
+  return pattern
+
+def absolute_matrix(ctx):
+  return abs(ctx['adj']).astype(np.float64)
+
+def metric_degree(ctx):
+  adj = ctx['adj']
+  return adj.getnnz(axis=1) + (adj.diagonal() != 0)
+
+def metric_weighted_degree(ctx):
+  return np.asarray(shared(ctx, 'absolute', absolute_matrix).sum(axis=1)).ravel()
+
+def metric_pos_degree(ctx):
+  return np.asarray((ctx['adj'] > 0).sum(axis=1)).ravel()
+
+def metric_neg_degree(ctx):
+  return np.asarray((ctx['adj'] < 0).sum(axis=1)).ravel()
+
+def metric_pagerank(ctx):
+  n = ctx['adj'].shape[0]
+  Q, is_dangling = shared(ctx, 'pattern_transition', lambda c: transition_matrix(shared(c, 'pattern', pattern_matrix)))
+  X, iterations, converged = pagerank_power(Q, is_dangling, np.ones((n, 1)), ctx['tol'], ctx['max_iter'])
+  report_convergence('PageRank w/o weight', iterations, converged)
+  return X[:, 0]
+
+def weighted_pagerank(ctx):
+  """PageRank using |weight|, together with the personalized one if ctx['seed'] is given."""
+  n = ctx['adj'].shape[0]
+  personalization = np.ones((n, 1))
+  if ctx.get('seed') is not None:
+    personalization = np.zeros((n, 2))
+    personalization[:, 0] = 1
+    personalization[ctx['seed'], 1] = 1
+  Q, is_dangling = shared(ctx, 'absolute_transition', lambda c: transition_matrix(shared(c, 'absolute', absolute_matrix)))
+  X, iterations, converged = pagerank_power(Q, is_dangling, personalization, ctx['tol'], ctx['max_iter'])
+  report_convergence('PageRank w/ weight', iterations[:1], converged[:1])
+  if ctx.get('seed') is not None:
+    report_convergence('Personalized PageRank w/ weight', iterations[1:], converged[1:])
+  return X
+
+def metric_pagerank_weight(ctx):
+  return shared(ctx, 'weighted_pagerank', weighted_pagerank)[:, 0]
 
-def ranking(g, filename, gene=''):
+def metric_personalized_pagerank(ctx):
+  return shared(ctx, 'weighted_pagerank', weighted_pagerank)[:, 1]
+
+def metric_eigenvector(ctx):
+  """Eigenvector centrality using |weight| (as nx.eigenvector_centrality_numpy)."""
+  absolute = shared(ctx, 'absolute', absolute_matrix)
+  n = absolute.shape[0]
+  if n == 0:
+    return np.zeros(0)
+  if n < 3:
+    values, vectors = np.linalg.eigh(absolute.toarray())
+    vector = vectors[:, -1]
+  else:
+    values, vectors = eigsh(absolute, k=1, which='LA')
+    vector = vectors[:, 0]
+  norm = np.linalg.norm(vector)
+  return vector / norm * np.sign(vector.sum()) if norm > 0 else vector
+
+def metric_kcore(ctx):
+  """Core number of each node, by peeling all nodes of degree <= k at once."""
+  pattern = shared(ctx, 'pattern', pattern_matrix)
+  pattern = pattern - sp.diags(pattern.diagonal())
+  degree = np.asarray(pattern.sum(axis=1)).ravel()
+  core = np.zeros(len(degree), dtype=int)
+  alive = np.ones(len(degree), dtype=bool)
+  k = 0
+  while alive.any():
+    k = max(k, int(degree[alive].min()))
+    removed = alive & (degree <= k)
+    while removed.any():
+      core[removed] = k
+      alive &= ~removed
+      degree -= pattern @ removed.astype(np.float64)
+      removed = alive & (degree <= k)
+  return core
+
+# name: (column, function)
+metrics = {
+  'degree': ('Degree', metric_degree),
+  'weighted_degree': ('Weighted degree', metric_weighted_degree),
+  'pos_degree': ('Positive degree', metric_pos_degree),
+  'neg_degree': ('Negative degree', metric_neg_degree),
+  'pagerank': ('PageRank w/o weight', metric_pagerank),
+  'pagerank_weight': ('PageRank w/ weight', metric_pagerank_weight),
+  'eigenvector': ('Eigenvector centrality', metric_eigenvector),
+  'kcore': ('Core number', metric_kcore),
+}
+default_metrics = ['degree', 'pagerank', 'pagerank_weight']
+
+def ranking_adjacency(genes, adj, filename, gene='', tol=1e-06, max_iter=100, metric_names=default_metrics):
+  """Rank the nodes of a graph given by its adjacency matrix.
+
+  The requested metrics are computed in one pass over the adjacency matrix, sharing
+  their intermediate results, and stored as the columns of a single csv file.
+  The time of each metric is printed.
+  Parameters
+  ----------
+  genes: the names of the nodes.
+  adj: the symmetric adjacency matrix with the weights (scipy sparse).
+  filename: csv file for storing the result
+  gene: for personalized PageRank
+  metric_names: the names of the metrics (the keys of metrics).
+  """
+  unknown = [name for name in metric_names if name not in metrics]
+  if unknown:
+    raise ValueError('unknown metrics: ' + ', '.join(unknown))
+  ctx = {'adj': sp.csr_matrix(adj), 'tol': tol, 'max_iter': max_iter}
+  columns = [(name,) + metrics[name] for name in metric_names]
+  if gene != 'None' and gene != '' and gene is not None:
+    index = np.flatnonzero(np.asarray(genes) == gene)
+    if len(index) == 0:
+      raise KeyError(gene + ' is not in the graph')
+    ctx['seed'] = index[0]
+    columns.append(('personalized_pagerank', 'Personalized PageRank w/ weight', metric_personalized_pagerank))
+  df = pd.DataFrame({'Gene': list(genes)})
+  for name, column, compute in columns:
+    t = time.perf_counter()
+    df[column] = compute(ctx)
+    print('{0}: {1:.3f} s'.format(name, time.perf_counter() - t))
+  df.to_csv(filename, index=False)
+
+# shared by the tasks in a worker process of '-P'.
+ppr_context = {}
+
+def init_ppr_worker(Q, is_dangling, tol, max_iter):
+  ppr_context.update({'Q': Q, 'is_dangling': is_dangling, 'tol': tol, 'max_iter': max_iter})
+
+def personalized_pagerank(seeds):
+  """Solve the PageRank personalized to each node index in seeds at once."""
+  Q = ppr_context['Q']
+  personalization = np.zeros((Q.shape[0], len(seeds)))
+  personalization[seeds, np.arange(len(seeds))] = 1
+  return pagerank_power(Q, ppr_context['is_dangling'], personalization, ppr_context['tol'], ppr_context['max_iter'])
+
+def read_gene_list(gene_file):
+  with open(gene_file) as f:
+    return [line.strip() for line in f if line.strip() != '']
+
+def batch_personalized_ranking(genes, adj, seed_genes, filename, jobs=1, tol=1e-06, max_iter=100):
+  """Compute PageRank (using the absolute value of weight) personalized to each of seed_genes.
+
+  The seeds are solved ppr_batch at a time as a matrix power iteration over the
+  shared transition matrix, and the batches are distributed over jobs processes.
+  The result is stored in a single csv file with one column per seed gene.
+  """
+  adj = sp.csr_matrix(adj)
+  index = pd.Index(genes)
+  positions = index.get_indexer(seed_genes)
+  missing = [s for s, p in zip(seed_genes, positions) if p < 0]
+  if missing:
+    print('{0} genes are not in the graph: {1}'.format(len(missing), ' '.join(missing)))
+  seed_genes = [s for s, p in zip(seed_genes, positions) if p >= 0]
+  positions = positions[positions >= 0]
+  Q, is_dangling = transition_matrix(abs(adj).astype(np.float64))
+  batches = [positions[i:i + ppr_batch] for i in range(0, len(positions), ppr_batch)]
+  if jobs > 1 and len(batches) > 1:
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_ppr_worker, initargs=(Q, is_dangling, tol, max_iter)) as executor:
+      results = list(executor.map(personalized_pagerank, batches))
+  else:
+    init_ppr_worker(Q, is_dangling, tol, max_iter)
+    results = [personalized_pagerank(batch) for batch in batches]
+  X = np.zeros((len(genes), 0))
+  if results:
+    X = np.hstack([r[0] for r in results])
+    iterations = np.concatenate([r[1] for r in results])
+    converged = np.concatenate([r[2] for r in results])
+    print('{0} seeds: {1}-{2} iterations, {3} not converged'.format(
+      len(seed_genes), iterations.min(), iterations.max(), int((~converged).sum())))
+  df = pd.DataFrame(X, columns=seed_genes)
+  df.insert(0, 'Gene', list(genes))
+  df.to_csv(filename, index=False)
+
+def ranking(g, filename, gene='', tol=1e-06, max_iter=100, metric_names=default_metrics):
   """Rank the nodes of a graph.
   Currently, this computes
   (1) Simple degree
   (2) PageRank, banilla
-  (3) PageRank, using weight 
-      (warning: this might not work well if the graph has both positive and negative edges)
+  (3) PageRank, using the absolute value of weight 
+  (4) PageRank personalized to gene, using the absolute value of weight (if gene is given)
+  Other metrics can be given by metric_names (see metrics).
   Parameters
   ----------
   g: the graph.
   filename: csv file for storing the result
-  gene: for personalized PageRank (work in progress)
+  gene: for personalized PageRank
   """
-  degs = [g.degree(i) for i in g.nodes ]
-  pr_noweight = nx.pagerank(g, weight=None)
-  pr_weight = negative_pagerank(g)
-  if gene != 'None' and gene != '': 
-    ppr_weight = nx.pagerank(g, weight='weight', personalization={gene:1})
-  df = pd.DataFrame([], columns=['Gene', 'Degree', 'PageRank w/o weight', 'PageRank w/ weight'])
-  df['Gene'] = g.nodes
-  df['Degree'] = degs
-  df['PageRank w/o weight'] = list(pr_noweight.values())
-  df['PageRank w/ weight'] = list(pr_weight.values())
-  df.to_csv(filename, index=False)
+  adj = nx.to_scipy_sparse_array(g, weight='weight', format='csr')
+  ranking_adjacency(list(g.nodes), adj, filename, gene, tol, max_iter, metric_names)
 
 if __name__ == '__main__':
   args = docopt(__doc__)
@@ -80,14 +336,21 @@ if __name__ == '__main__':
   print(data_filename)
   
   gene = args['-p']
+  gene_file = args['-P']
   result_file = args['-o']
   if result_file == 'None' or result_file == '':
     gene_prefix = ''
     if gene != 'None' and gene != '':
       gene_prefix = gene + '_'
-    result_file = data_dir + '/' + gene_prefix + data_file_without_ext + "_rank.csv"
+    suf = "_rank.csv"
+    if gene_file != 'None':
+      suf = "_ppr.csv"
+    result_file = data_dir + '/' + gene_prefix + data_file_without_ext + suf
   print(result_file)
-  g = nx.Graph(my_read_pajek(data_file))
-  ranking(g, result_file, gene)
+  genes, x, y, adj = load_adjacency(data_file)
+  if gene_file != 'None':
+    batch_personalized_ranking(genes, adj, read_gene_list(gene_file), result_file, args['-j'], args['-t'], args['-i'])
+  else:
+    ranking_adjacency(genes, adj, result_file, gene, args['-t'], args['-i'], args['-M'])
   
   
@@ -0,0 +1,182 @@
+__doc__ = (
+"""
+  List, evict or clear the entries of a result cache used by compute_gcm.py with '-C'.
+  (The cache holds the preprocessed matrices, the MAGIC-imputed matrices and the correlation matrices.)
+
+usage:
+{f} <cache_dir> [-s <stage>] [--clear | -Z <cache_size>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  <cache_dir>              specify the cache directory.
+  -s <stage>               only the entries of the stage (preprocessed|imputed|correlation).
+  --clear                  remove the entries.
+  -Z <cache_size>          remove the least recently used entries until the cache is at most <cache_size> MB.
+""").format(f=__file__)
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import numpy as np
+import pandas as pd
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+# A cache entry is a directory "cache_dir"/"key" containing
+#   the arrays of the stage (.npy, memory-mapped by readers; a correlation entry is a correlation store),
+#   entry.json: the stage, the size in bytes, the creation and last access times, and the key parts.
+# The key is the sha256 of the key parts: the digests of the input files, the parameters of the stage
+# and its inputs, and the versions of the libraries. An entry is written to a temporary directory
+# and renamed, so a reader never sees a partial entry.
+entry_filename = 'entry.json'
+cache_version = 1
+stages = ['preprocessed', 'imputed', 'correlation']
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '<cache_dir>': Use(str),
+  '-s': Or(None, And(Use(str), lambda s: s in stages), error="<stage> should be preprocessed, imputed or correlation"),
+  '--clear': bool,
+  '-Z': Or(None, And(Use(float), lambda n: 0 <= n)),
+})
+
+def library_versions():
+  """The versions of the libraries whose results are cached."""
+  import scipy
+  import scprep
+  import magic
+  import graphtools
+  return {'numpy': np.__version__, 'scipy': scipy.__version__, 'pandas': pd.__version__,
+          'scprep': scprep.__version__, 'magic': magic.__version__, 'graphtools': graphtools.__version__}
+
+def entry_key(parts):
+  """The key of the entry of parts (a JSON-serializable dict)."""
+  text = json.dumps(dict(parts, cache_version=cache_version), sort_keys=True, default=str)
+  return hashlib.sha256(text.encode()).hexdigest()
+
+def entry_path(cache_dir, key):
+  return os.path.join(cache_dir, key)
+
+def read_entry(path):
+  with open(os.path.join(path, entry_filename)) as f:
+    return json.load(f)
+
+def write_entry(path, entry):
+  """Write entry.json through a temporary file, so a reader never sees a partial file."""
+  tmp_file = os.path.join(path, entry_filename + '.tmp{0}'.format(os.getpid()))
+  with open(tmp_file, 'w') as f:
+    json.dump(entry, f, default=str)
+  os.replace(tmp_file, os.path.join(path, entry_filename))
+
+def lookup(cache_dir, key):
+  """The path of the entry of key, or None. A hit updates the last access time of the entry."""
+  path = entry_path(cache_dir, key)
+  if not os.path.exists(os.path.join(path, entry_filename)):
+    return None
+  entry = read_entry(path)
+  entry['last_access'] = time.time()
+  write_entry(path, entry)
+  print('cache hit: {0} {1}'.format(entry['stage'], key[:12]))
+  return path
+
+def new_entry(cache_dir, key):
+  """A temporary directory to write the files of the entry of key (see commit_entry)."""
+  path = entry_path(cache_dir, key) + '.tmp{0}'.format(os.getpid())
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(path)
+  return path
+
+def commit_entry(cache_dir, key, tmp_path, stage, parts):
+  """Record the entry written in tmp_path (see new_entry) as the entry of key, and return its path."""
+  size = sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path))
+  now = time.time()
+  entry = {'stage': stage, 'size': size, 'created': now, 'last_access': now, 'parts': parts}
+  write_entry(tmp_path, entry)
+  path = entry_path(cache_dir, key)
+  try:
+    os.rename(tmp_path, path)
+  except OSError:
+    # another process has written the same entry.
+    shutil.rmtree(tmp_path, ignore_errors=True)
+  print('cache store: {0} {1} ({2:.1f} MB)'.format(stage, key[:12], size / 2**20))
+  return path
+
+def save_arrays(cache_dir, key, stage, parts, **arrays):
+  """Store the arrays as the entry of key, and return its path."""
+  tmp_path = new_entry(cache_dir, key)
+  for name, array in arrays.items():
+    np.save(os.path.join(tmp_path, name + '.npy'), array)
+  return commit_entry(cache_dir, key, tmp_path, stage, parts)
+
+def load_array(path, name):
+  return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+def list_entries(cache_dir, stage=None):
+  """The entries of the cache as a DataFrame (key, stage, size_mb, created, last_access), least recently used first."""
+  rows = []
+  if os.path.isdir(cache_dir):
+    for key in os.listdir(cache_dir):
+      path = entry_path(cache_dir, key)
+      if not os.path.exists(os.path.join(path, entry_filename)):
+        continue
+      entry = read_entry(path)
+      if stage is not None and entry['stage'] != stage:
+        continue
+      rows.append({'key': key, 'stage': entry['stage'], 'size_mb': entry['size'] / 2**20,
+                   'created': pd.Timestamp(entry['created'], unit='s').floor('s'),
+                   'last_access': pd.Timestamp(entry['last_access'], unit='s').floor('s')})
+  df = pd.DataFrame(rows, columns=['key', 'stage', 'size_mb', 'created', 'last_access'])
+  return df.sort_values('last_access', ignore_index=True)
+
+def remove_entry(cache_dir, key):
+  shutil.rmtree(entry_path(cache_dir, key), ignore_errors=True)
+
+def evict(cache_dir, cache_size, stage=None, keep=()):
+  """Remove the least recently used entries until the total size is at most cache_size MB.
+
+  The entries of the keys in keep (e.g. those in use) are never removed. Returns the removed keys.
+  """
+  df = list_entries(cache_dir, stage)
+  excess = df['size_mb'].sum() - cache_size
+  removed = []
+  for row in df.itertuples():
+    if excess <= 0:
+      break
+    if row.key in keep:
+      continue
+    remove_entry(cache_dir, row.key)
+    excess -= row.size_mb
+    removed.append(row.key)
+  return removed
+
+def clear(cache_dir, stage=None):
+  df = list_entries(cache_dir, stage)
+  for key in df['key']:
+    remove_entry(cache_dir, key)
+  return df['key'].tolist()
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  cache_dir = os.path.abspath(args['<cache_dir>'])
+  if args['--clear']:
+    print('{0} entries removed'.format(len(clear(cache_dir, args['-s']))))
+  elif args['-Z'] is not None:
+    print('{0} entries removed'.format(len(evict(cache_dir, args['-Z'], args['-s']))))
+  df = list_entries(cache_dir, args['-s'])
+  with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.max_colwidth', 20):
+    print(df)
+  print('{0} entries, {1:.1f} MB'.format(len(df), df['size_mb'].sum()))
@@ -0,0 +1,281 @@
+__doc__ = (
+"""
+  Run compute_gcm.py, construct_gcn.py and the selected downstream stages
+  (rank_genes.py, louvain_clustering.py, plot_gcn.py) in one process.
+  The edges and the network are passed in memory between the stages, and the time of each stage
+  is reported with the growth of the maximum resident memory (RSS) of the process in the stage
+  and the maximum RSS so far (with --trace-memory, the peak memory allocated in each stage
+  by Python and numpy is traced instead of the RSS growth, which slows down the stages).
+  Default output ('data_dir' is the directory of <data_file>, 'data_prefix' is the prefix of <data_file>):
+  "data_dir"/[corr_|wom_corr_]"data_prefix"_rank.csv (rank),
+  "data_dir"/louvain_[corr_|wom_corr_]"data_prefix"_"idx".net (louvain),
+  "data_dir"/[corr_|wom_corr_]"data_prefix".png (plot),
+  and, if requested, the edge list (.npz) and the network (.net, or .gcg with '-b') of the same prefix.
+  With -L, the expression files listed in <list_file> (e.g., the time points of an experiment) are run
+  by <jobs> processes sharing the dictionary and the coordinates of the vertices; the network of each
+  file is always output, and the edges of all of them are output as one table
+  "list_dir"/"list_prefix"_edges.csv (columns: time, gene_u, gene_v, weight).
+  Each line of <list_file> is an expression file, optionally preceded by its time point and a comma
+  (e.g., "day7,data/day7.csv"); the time point is the prefix of the file by default.
+
+usage:
+{f} <data_file> <dict_file> <max_neg> <min_pos> [-s <stages>] [-c <threshold_cell>] [-g <threshold_gene>] [-n] [--circular] [-t <tile_rows>] [-M <mem_budget>] [-e] [-w [-b]] [-k <communities>] [--trace-memory] [-o <output_prefix>]
+{f} -L <list_file> <dict_file> <max_neg> <min_pos> [-j <jobs>] [-s <stages>] [-c <threshold_cell>] [-g <threshold_gene>] [-n] [--circular] [-t <tile_rows>] [-M <mem_budget>] [-e] [-b] [-k <communities>] [--trace-memory] [-o <output_prefix>]
+{f} -h | --help
+
+options:
+  -h, --help               show this help message and exit.
+  <data_file>              specify the data file containing the expression data (row: gene, column: cell).
+  -L <list_file>           specify the file listing the expression files (one per line).
+  -j <jobs>                specify the number of processes running the files of <list_file> [default: 1].
+  <dict_file>              specify the dictionary file.
+  <max_neg>                specify the maximum negative value of correlation.
+  <min_pos>                specify the minimum positive value of correlation.
+  -s <stages>              specify the stages run after constructing the network
+                           (comma-separated among rank, louvain and plot, or none) [default: rank,louvain,plot].
+  -c <threshold_cell>      specify the threshold of cells [default: 0].
+  -g <threshold_gene>      specify the threshold of genes [default: 0].
+  -n                       run without MAGIC.
+  --circular               set circular coordinate flag.
+  -t <tile_rows>           specify the number of rows of a correlation tile (0: derived from -M) [default: 0].
+  -M <mem_budget>          specify the memory budget for a correlation tile in MB [default: 1024].
+  -e                       output the edge list (.npz) as compute_gcm.py with '-e' does.
+  -w                       output the network (.net) as construct_gcn.py does.
+  -b                       output the network as a binary graph store (.gcg directory) instead of .net.
+  -k <communities>         specify the number of the largest clusters output by louvain [default: 10].
+  --trace-memory           trace the peak memory allocated in each stage by tracemalloc (slower).
+  -o <output_prefix>       specify the prefix of output files (of the edge table with -L).
+""").format(f=__file__)
+
+import os
+import sys
+import functools
+import resource
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import networkx as nx
+import compute_gcm
+import construct_gcn
+import corr_engine
+import graph_store
+import louvain_clustering
+import plot_gcn
+import rank_genes
+from concurrent.futures import ProcessPoolExecutor
+from docopt import docopt
+from schema import Schema, SchemaError, And, Or, Use, Optional
+
+stage_names = ['rank', 'louvain', 'plot']
+
+# define the schema for args.
+schema = Schema({
+  '--help': bool,
+  '<data_file>': Or(None, Use(str)),
+  '-L': Or(None, Use(str)),
+  '-j': And(Use(int), lambda n: 0 < n),
+  '<dict_file>': Use(str),
+  '<max_neg>': Use(float),
+  '<min_pos>': Use(float),
+  '-s': And(Use(lambda s: [] if s == 'none' else s.split(',')), lambda l: all(s in stage_names for s in l),
+            error="<stages> should be rank, louvain, plot (comma-separated) or none"),
+  '-c': And(Use(int), lambda n: 0 <= n),
+  '-g': And(Use(int), lambda n: 0 <= n),
+  '-n': bool,
+  '--circular': bool,
+  '-t': And(Use(int), lambda n: 0 <= n),
+  '-M': And(Use(float), lambda n: 0 < n),
+  '-e': bool,
+  '-w': bool,
+  '-b': bool,
+  '-k': And(Use(int), lambda n: 0 <= n),
+  '--trace-memory': bool,
+  Optional('-o'): Use(str),
+})
+
+def max_rss():
+  """The maximum resident memory of this process so far in MB (ru_maxrss is in bytes on macOS, KB elsewhere)."""
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 1024.0
+
+def run_stage(report, name, fn, *args, trace_memory=False):
+  """Run fn(*args) as a stage, and append (name, seconds, memory of the stage, max RSS so far) to report.
+
+  The memory of the stage (MB) is the growth of the max RSS during the stage (0 if it stays below
+  the peak of the earlier stages). With trace_memory, it is instead the peak of the memory traced
+  by tracemalloc above the memory held when the stage starts; tracing is stopped after the stage.
+  """
+  print('== {0}'.format(name))
+  rss = max_rss()
+  if trace_memory:
+    tracemalloc.start()
+  t = time.perf_counter()
+  try:
+    result = fn(*args)
+  finally:
+    elapsed = time.perf_counter() - t
+    if trace_memory:
+      memory = tracemalloc.get_traced_memory()[1] / 2**20
+      tracemalloc.stop()
+  if not trace_memory:
+    memory = max_rss() - rss
+  report.append((name, elapsed, memory, max_rss()))
+  print('== {0}: {1:.2f} s, memory {2:.0f} MB, max RSS so far {3:.0f} MB'.format(name, elapsed, memory, report[-1][3]))
+  return result
+
+def correlation_edges(emt_data, thres_cell, thres_gene, is_magic, max_neg, min_pos, tile_rows, mem_budget):
+  """The edges of the correlation matrix at most max_neg or at least min_pos (see compute_gcm.py with '-e')."""
+  allgenes, iter_blocks = compute_gcm.correlation_blocks(emt_data, thres_cell, thres_gene, is_magic)
+  if tile_rows == 0:
+    tile_rows = corr_engine.tile_rows_for_budget(len(allgenes), mem_budget)
+  edge_i, edge_j, weight = corr_engine.extract_edges(iter_blocks(tile_rows), max_neg, min_pos)
+  print('{0} genes, {1} edges'.format(len(allgenes), len(weight)))
+  return (allgenes, edge_i, edge_j, weight)
+
+def run_pipeline(data_file, dict_file, max_neg, min_pos, stages=stage_names, thres_cell=0, thres_gene=0,
+                 is_magic=True, circularmode=False, tile_rows=0, mem_budget=1024, save_edges=False,
+                 save_graph=False, is_binary=False, n_communities=10, output_prefix='', gene_dict=None, dict_table=None,
+                 trace_memory=False):
+  """Run the pipeline from the expression data to the selected stages.
+
+  gene_dict (the dictionary read from dict_file) and dict_table (see construct_gcn.lookup_vertices)
+  can be given to share them between runs.
+  trace_memory is given to run_stage.
+  Returns (report, network): the report is a list of (stage, seconds, memory of the stage, max RSS so far) in MB,
+  and the network is (names, x, y, u, v, weight) given by construct_gcn.edges2arrays.
+  """
+  report = []
+  stage = functools.partial(run_stage, report, trace_memory=trace_memory)
+  emt_data, output_prefix = stage('load', compute_gcm.load_emt, data_file, output_prefix, is_magic, '')
+  allgenes, edge_i, edge_j, weight = stage('correlation', correlation_edges, emt_data, thres_cell, thres_gene,
+                                           is_magic, max_neg, min_pos, tile_rows, mem_budget)
+  del emt_data
+  if save_edges:
+    corr_engine.save_edges(output_prefix + '.npz', allgenes, edge_i, edge_j, weight, max_neg, min_pos)
+
+  def construct():
+    names, x, y, u, v, w = construct_gcn.edges2arrays(max_neg, min_pos, allgenes, edge_i, edge_j, weight,
+                                                      gene_dict if gene_dict is not None else construct_gcn.load_gene_dict(dict_file),
+                                                      circularmode, dict_table)
+    g = None
+    if 'louvain' in stages or (save_graph and not is_binary):
+      g = construct_gcn.arrays2graph(names, x, y, u, v, w, nx.Graph())
+    if save_graph and is_binary:
+      graph_store.write_graph_arrays(output_prefix + graph_store.store_ext, names, x, y, u, v, w)
+    elif save_graph:
+      nx.write_pajek(g, output_prefix + '.net')
+    print("n = {0}, m = {1}".format(len(names), len(w)))
+    return (names, x, y, u, v, w, g)
+  names, x, y, u, v, w, g = stage('network', construct)
+
+  data_dir, prefix = os.path.split(output_prefix)
+  if 'rank' in stages:
+    adj = graph_store.adjacency_from_edges(len(names), u, v, w)
+    stage('rank', rank_genes.ranking_adjacency, names, adj, output_prefix + '_rank.csv')
+  if 'louvain' in stages:
+    stage('louvain', lambda: louvain_clustering.louvain(g, data_dir + '/louvain_' + prefix + '_', plot=False,
+                                                        n_communities=n_communities))
+  if 'plot' in stages:
+    stage('plot', plot_gcn.render_gcn, x, y, 'green', np.full(len(names), 200), u, v, w, output_prefix + '.png')
+  return (report, (names, x, y, u, v, w))
+
+
+def read_data_list(list_file):
+  """Read the list of expression files as [(time point, file)]; the files are relative to the list."""
+  list_dir = os.path.dirname(os.path.abspath(list_file))
+  data_list = []
+  with open(list_file) as f:
+    for line in f:
+      line = line.strip()
+      if line == '' or line.startswith('#'):
+        continue
+      if ',' in line:
+        time_point, data_file = [s.strip() for s in line.split(',', 1)]
+      else:
+        data_file = line
+        time_point = os.path.splitext(os.path.basename(data_file))[0]
+      data_list.append((time_point, os.path.join(list_dir, data_file)))
+  return data_list
+
+# shared by the files run in a worker process of the batch mode.
+batch_context = {}
+
+def init_batch_worker(gene_dict, dict_table, options):
+  batch_context['gene_dict'] = gene_dict
+  batch_context['dict_table'] = dict_table
+  batch_context['options'] = options
+
+def run_time_point(time_point, data_file):
+  """Run the pipeline for a file, and return (time point, report, gene_u, gene_v, weight)."""
+  report, (names, x, y, u, v, w) = run_pipeline(data_file, None, gene_dict=batch_context['gene_dict'],
+                                                dict_table=batch_context['dict_table'], save_graph=True,
+                                                **batch_context['options'])
+  return (time_point, report, names[u], names[v], w)
+
+def run_batch(list_file, dict_file, edge_file, jobs=1, circularmode=False, **options):
+  """Run the pipeline for each file listed in list_file by jobs processes, and output all the edges to edge_file.
+
+  The dictionary and the vertex table of its genes are built once and shared by the processes.
+  options are passed to run_pipeline.
+  Returns [(time point, report)].
+  """
+  data_list = read_data_list(list_file)
+  gene_dict = construct_gcn.load_gene_dict(dict_file)
+  dict_table = construct_gcn.vertex_table(gene_dict.index, gene_dict, circularmode)
+  print('{0} files, {1} vertices in the dictionary'.format(len(data_list), len(dict_table)))
+  options['circularmode'] = circularmode
+  time_points = [t for t, f in data_list]
+  data_files = [f for t, f in data_list]
+  if jobs > 1 and len(data_list) > 1:
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker, initargs=(gene_dict, dict_table, options)) as executor:
+      results = list(executor.map(run_time_point, time_points, data_files))
+  else:
+    init_batch_worker(gene_dict, dict_table, options)
+    results = [run_time_point(t, f) for t, f in data_list]
+  edges = pd.concat([pd.DataFrame({'time': time_point, 'gene_u': gene_u, 'gene_v': gene_v, 'weight': weight})
+                     for (time_point, report, gene_u, gene_v, weight) in results], ignore_index=True)
+  print('edges', edge_file)
+  edges.to_csv(edge_file, index=False)
+  return [(time_point, report) for (time_point, report, gene_u, gene_v, weight) in results]
+
+def print_report(report, trace_memory=False):
+  if trace_memory:
+    print('stage          time (s)   traced peak (MB)   max RSS so far (MB)')
+  else:
+    print('stage          time (s)    RSS growth (MB)   max RSS so far (MB)')
+  for name, elapsed, peak, rss in report:
+    print('{0:<14} {1:>8.2f}   {2:>16.0f}   {3:>19.0f}'.format(name, elapsed, peak, rss))
+  print('{0:<14} {1:>8.2f}'.format('total', sum(report[k][1] for k in range(len(report)))))
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  try:
+    args = schema.validate(args)
+  except SchemaError as error:
+    print(error)
+    sys.exit(1)
+  print(args)
+
+  max_neg = -1.0 * args['<max_neg>']
+  min_pos = args['<min_pos>']
+  if args['-L'] is not None:
+    edge_file = args['-o']
+    if edge_file == 'None' or edge_file == '':
+      edge_file = os.path.splitext(os.path.abspath(args['-L']))[0]
+    edge_file = edge_file + '_edges.csv'
+    reports = run_batch(args['-L'], args['<dict_file>'], edge_file, args['-j'], args['--circular'],
+                        max_neg=max_neg, min_pos=min_pos, stages=args['-s'], thres_cell=args['-c'],
+                        thres_gene=args['-g'], is_magic=not args['-n'], tile_rows=args['-t'], mem_budget=args['-M'],
+                        save_edges=args['-e'], is_binary=args['-b'], n_communities=args['-k'],
+                        trace_memory=args['--trace-memory'])
+    for time_point, report in reports:
+      print('## {0}'.format(time_point))
+      print_report(report, args['--trace-memory'])
+  else:
+    report, network = run_pipeline(args['<data_file>'], args['<dict_file>'], max_neg, min_pos,
+                                   args['-s'], args['-c'], args['-g'], not args['-n'], args['--circular'], args['-t'], args['-M'],
+                                   args['-e'], args['-w'], args['-b'], args['-k'], args['-o'], trace_memory=args['--trace-memory'])
+    print_report(report, args['--trace-memory'])